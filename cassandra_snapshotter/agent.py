@@ -1,44 +1,120 @@
+from boto.exception import S3ResponseError
 from boto.s3.connection import S3Connection
 try:
     from cStringIO import StringIO
 except ImportError:
     from StringIO import StringIO
-import glob
+from collections import namedtuple
+from datetime import datetime
+import errno
+import fnmatch
+import hashlib
+import io
+import json
 import logging
 import multiprocessing
-from joblib import Parallel, delayed
+from multiprocessing.dummy import Pool
 import os
+import sqlite3
+import threading
 import time
-from timeout import timeout
-from utils import add_s3_arguments, base_parser, map_wrap, get_s3_connection_host
-from snappy import StreamCompressor
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+from timeout import CancelledError, Deadline, DeadlineFile, set_socket_timeout
+from utils import add_s3_arguments, base_parser, get_s3_connection_host
+from utils import file_checksum, FILE_INDEX_DIR, FILE_INDEX_TIME_FORMAT
+from compression import codec_for_file, CODECS, DEFAULT_CODEC
+from throttle import NodeLoad, Throttle
+from transfer import TransferEngine, list_multipart_uploads
+from snapshotting import RestoreWorker, Snapshot, sstable_component
 
 
 DEFAULT_CONCURRENCY = max(multiprocessing.cpu_count() - 1, 1)
+DEFAULT_PART_CONCURRENCY = 4
 BUFFER_SIZE = 62914560
 MAX_RETRY_COUNT = 3
 SLEEP_TIME = 2
 UPLOAD_TIMEOUT = 600
+# keyspaces walked at the same time by create-upload-manifest
+MANIFEST_CONCURRENCY = 8
+# files up to this size (Digest, Filter, Summary, TOC... components) are uploaded in batches
+SMALL_FILE_SIZE = 1048576
+SMALL_FILE_BATCH = 32
+
+# what the upload index needs of the stat of a file
+FileStat = namedtuple('FileStat', ['st_ino', 'st_size', 'st_mtime'])
 
 logger = logging.getLogger(__name__)
 
 
-def compressed_pipe(input_path):
+class BufferPool(object):
     """
-    returns a generator that yields compressed chunks of
-    the given file_path
+    A fixed set of reusable buffers of BUFFER_SIZE bytes
+
+    Buffers are allocated on first use and recycled afterwards, acquire
+    blocks while all of them are in use: this bounds the memory used to
+    read files no matter how many (or how large) files are uploaded.
+    """
+
+    def __init__(self, count, size=BUFFER_SIZE):
+        self.count = count
+        self.size = size
+        self._free = []
+        self._available = threading.Semaphore(count)
+        self._lock = threading.Lock()
 
-    compression is done with snappy
+    def acquire(self):
+        self._available.acquire()
+        with self._lock:
+            if self._free:
+                return self._free.pop()
+        return bytearray(self.size)
 
+    def release(self, buf):
+        with self._lock:
+            self._free.append(buf)
+        self._available.release()
+
+
+def read_into(file_object, buf):
+    """
+    fills buf with the next bytes of file_object, returns the number
+    of bytes read (less than the buffer size only at the end of the file)
     """
-    compressor = StreamCompressor()
+    view = memoryview(buf)
+    length = 0
+    while length < len(buf):
+        read = file_object.readinto(view[length:])
+        if not read:
+            break
+        length += read
+    return length
 
-    with open(input_path, 'rb') as file_object:
+
+def file_parts(input_path, buffers, throttle=None):
+    """
+    returns a generator that yields the parts (chunks of BUFFER_SIZE bytes)
+    of the given file_path as (buffer, length) tuples
+
+    parts are read into buffers acquired from the given pool, whoever is
+    done with a part releases its buffer
+
+    """
+    with io.open(input_path, 'rb', buffering=0) as file_object:
         while True:
-            data = file_object.read(BUFFER_SIZE)
-            if not data:
+            buf = buffers.acquire()
+            length = read_into(file_object, buf)
+            if not length:
+                buffers.release(buf)
                 break
-            yield StringIO(compressor.add_chunk(data))
+            if throttle is not None:
+                throttle.disk(length)
+            yield buf, length
 
 
 def get_bucket(s3_bucket, aws_access_key_id, aws_secret_access_key, s3_connection_host):
@@ -50,87 +126,577 @@ def get_bucket(s3_bucket, aws_access_key_id, aws_secret_access_key, s3_connectio
     return connection.get_bucket(s3_bucket, validate=False)
 
 
-def destination_path(s3_base_path, file_path, compressed=True):
-    suffix = compressed and '.snappy' or ''
-    return '/'.join([s3_base_path, file_path + suffix])
+def destination_path(s3_base_path, file_path, codec):
+    return '/'.join([s3_base_path, file_path + codec.suffix])
+
+
+def object_path(s3_objects_path, file_path, size, checksum, codec):
+    """
+    content addressed destination of a file
+
+    sstables are immutable: the file name (which contains the sstable
+    generation) together with its size and checksum identifies its content,
+    the same object is then shared by all the snapshots that contain it
 
+    """
+    name = '%s-%d-%s%s' % (checksum, size, os.path.basename(file_path), codec.suffix)
+    return '/'.join([s3_objects_path, checksum[:2], name])
 
-@map_wrap
-def upload_file_imap(bucket, source, destination, s3_ssenc):
-    upload_file(bucket, source, destination, s3_ssenc)
 
+def file_index_path(s3_base_path):
+    """
+    every put run writes its own index, incremental backups add more
+    indexes next to the ones of the snapshot
+    """
+    run_name = datetime.utcnow().strftime(FILE_INDEX_TIME_FORMAT)
+    return '/'.join([s3_base_path, FILE_INDEX_DIR, '%s.json' % run_name])
 
-def upload_file(bucket, source, destination, s3_ssenc):
-    completed = False
+
+class UploadIndex(object):
+    """
+    Keeps track on disk of the files already uploaded from this node
+
+    A file is identified by its inode, size and mtime (snapshots and backups
+    are hard links to the same sstables), so that retried or incremental
+    runs only upload new or changed files and checksums are computed once.
+
+    The index is a sqlite database, every thread opens its own connection.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+
+    @property
+    def connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = self._local.connection = sqlite3.connect(self.path, timeout=60)
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS uploads ('
+                'path TEXT, inode INTEGER, mtime REAL, size INTEGER, '
+                'key TEXT, etag TEXT, stored_size INTEGER, checksum TEXT, parts TEXT, '
+                'PRIMARY KEY (path, key))')
+            connection.execute(
+                'CREATE INDEX IF NOT EXISTS uploads_inode ON uploads (inode, size, mtime)')
+            columns = [row[1] for row in connection.execute('PRAGMA table_info(uploads)')]
+            if 'parts' not in columns:
+                # indexes written before the part boundaries were recorded
+                try:
+                    connection.execute('ALTER TABLE uploads ADD COLUMN parts TEXT')
+                except sqlite3.OperationalError:  # added by another thread meanwhile
+                    pass
+        return connection
+
+    def lookup(self, stat, key):
+        """
+        returns the stored size, etag, checksum and parts of a file already uploaded to key
+        """
+        row = self.connection.execute(
+            'SELECT stored_size, etag, checksum, parts FROM uploads WHERE key = ? AND inode = ? AND size = ? AND mtime = ?',
+            (key, stat.st_ino, stat.st_size, stat.st_mtime)).fetchone()
+        if row is None:
+            return None
+        stored_size, etag, checksum, parts = row
+        return stored_size, etag, checksum, parts and json.loads(parts)
+
+    def checksum(self, stat):
+        row = self.connection.execute(
+            'SELECT checksum FROM uploads WHERE inode = ? AND size = ? AND mtime = ? AND checksum IS NOT NULL',
+            (stat.st_ino, stat.st_size, stat.st_mtime)).fetchone()
+        return row and row[0]
+
+    def record(self, path, stat, key, etag, stored_size, checksum=None, parts=None):
+        with self.connection:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO uploads VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (path, stat.st_ino, stat.st_mtime, stat.st_size, key, etag, stored_size, checksum,
+                 parts and json.dumps(parts)))
+
+
+def upload_single_part(engine, source, destination, s3_ssenc, codec, buffers, throttle=None):
+    """
+    uploads a file that fits in a buffer with a single request
+    instead of the three of a multipart upload, see upload_file
+    """
+    checksum = hashlib.sha1()
+    # a single buffer of the pool: the uploads of small files must not
+    # hold more buffers than the threads uploading them
+    buf = buffers.acquire()
+    try:
+        with io.open(source, 'rb', buffering=0) as file_object:
+            length = read_into(file_object, buf)
+            if file_object.read(1):
+                raise IOError("%s grew larger than a part while uploading it" % source)
+        if throttle is not None:
+            throttle.disk(length)
+        checksum.update(buffer(buf, 0, length))
+        chunk = codec.compress(buf, length)
+    finally:
+        buffers.release(buf)
+    if throttle is not None:
+        throttle.network(len(chunk))
+
+    def put():
+        key = engine.bucket.new_key(destination)
+        key.set_contents_from_file(DeadlineFile(StringIO(chunk), Deadline(UPLOAD_TIMEOUT)), encrypt_key=s3_ssenc)
+        return key.etag
+
+    etag = engine.retry(put)
+    return [[len(chunk), length]], etag, checksum.hexdigest()
+
+
+def upload_file(engine, source, destination, s3_ssenc, codec, buffers, throttle=None, size=None):
+    """
+    uploads a file compressed, returns the [stored size, size] of its parts,
+    the etag of the uploaded object and the checksum of the file
+
+    files known (by their size) to fit in a single part are uploaded
+    with a single request, see upload_single_part
+
+    failed parts are retried on their own by the engine, when a part still
+    fails the file is retried reusing the parts S3 already has (ListParts);
+    the upload only starts over when S3 no longer knows the multipart
+    upload and is cancelled when the error is not worth retrying
+    """
+    if size is not None and size <= buffers.size:
+        return upload_single_part(engine, source, destination, s3_ssenc, codec, buffers, throttle)
+
+    def initiate_multipart_upload():
+        return engine.bucket.initiate_multipart_upload(destination, encrypt_key=s3_ssenc)
+
+    mp = engine.retry(initiate_multipart_upload)
+    uploaded = {}
     retry_count = 0
-    while not completed and retry_count < MAX_RETRY_COUNT:
-        mp = bucket.initiate_multipart_upload(destination, encrypt_key=s3_ssenc)
+    while True:
         try:
-            for i, chunk in enumerate(compressed_pipe(source)):
-                upload_chunk(mp, chunk, i + 1)
-        except Exception:
-            logger.warn("Error uploading file %s to %s. Retry count: %d" % (source, destination, retry_count))
-            cancel_upload(bucket, mp, destination)
+            parts, checksum = upload_parts(engine, mp, source, codec, buffers, throttle, uploaded)
+            result = engine.retry(engine.multipart_upload(mp).complete_upload)
+            return parts, result.etag, checksum
+        except Exception as e:
             retry_count += 1
-            if retry_count >= MAX_RETRY_COUNT:
-                logger.exception("Retried too many times uploading file")
+            gone = upload_gone(e)
+            if retry_count >= MAX_RETRY_COUNT or not (gone or engine.retry_policy.is_retryable(e)):
+                logger.exception("Giving up uploading file %s to %s" % (source, destination))
+                if not gone:
+                    cancel_upload(engine.bucket, mp, destination)
                 raise
-        mp.complete_upload()
-        completed = True
+            logger.warn("Error uploading file %s to %s. Retry count: %d" % (source, destination, retry_count))
+        time.sleep(engine.retry_policy.delay(retry_count))
+        if not gone:
+            try:
+                uploaded = reusable_parts(engine, mp, uploaded)
+            except Exception as e:
+                if not upload_gone(e):
+                    cancel_upload(engine.bucket, mp, destination)
+                    raise
+                gone = True
+        if gone:
+            logger.warn("Multipart upload of %s to %s is gone, starting over" % (source, destination))
+            mp = engine.retry(initiate_multipart_upload)
+            uploaded = {}
+
+
+def upload_gone(error):
+    """
+    whether S3 no longer knows the multipart upload (aborted or expired)
+    """
+    return isinstance(error, S3ResponseError) and error.status == 404
 
 
-@timeout(UPLOAD_TIMEOUT)
-def upload_chunk(mp, chunk, index):
-    mp.upload_part_from_file(chunk, index)
+def reusable_parts(engine, mp, uploaded):
+    """
+    returns the parts of uploaded (part number: ([stored size, size], md5))
+    that S3 lists for mp with the same md5 as when they were uploaded
+    """
+    def list_parts():
+        return dict((part.part_number, part.etag.strip('"')) for part in engine.multipart_upload(mp))
+
+    listed = engine.retry(list_parts)
+    reusable = dict((part_num, uploaded[part_num]) for part_num, etag in listed.items()
+                    if part_num in uploaded and uploaded[part_num][1] == etag)
+    logger.info("Reusing %d parts of %s already on S3" % (len(reusable), mp.key_name))
+    return reusable
+
+
+def upload_parts(engine, mp, source, codec, buffers, throttle=None, uploaded=None):
+    """
+    reads a file sequentially and compresses / uploads its parts on the
+    transfer engine, reading waits for a free buffer: the buffers bound the
+    parts in memory of all the files uploaded at the same time
+
+    every part is compressed as a complete stream so that parts can be
+    compressed independently, their concatenation is still a valid stream
+
+    uploaded (part number: ([stored size, size], md5)) lists the parts already
+    on S3, they are only read for the checksum; the parts uploaded are added to it
+
+    returns the [stored size, size] of every part, so that restores can
+    download and decompress parts on their own, and the checksum of the file
+    """
+    if uploaded is None:
+        uploaded = {}
+    failed = threading.Event()
+    checksum = hashlib.sha1()
+    parts = {}
+    results = {}
+    try:
+        for i, (buf, length) in enumerate(file_parts(source, buffers, throttle)):
+            if failed.is_set():
+                buffers.release(buf)
+                break
+            checksum.update(buffer(buf, 0, length))
+            part_num = i + 1
+            if part_num in uploaded and uploaded[part_num][0][1] == length:
+                buffers.release(buf)
+                parts[part_num] = uploaded[part_num][0]
+                continue
+            results[part_num] = engine.submit(upload_part, engine, mp, codec, buffers, buf, length, part_num,
+                                              failed, throttle)
+    except Exception:
+        failed.set()
+        raise
+    finally:
+        # the upload is only completed or cancelled once none of its parts is running
+        for result in results.values():
+            result.wait()
+        for part_num, result in results.items():
+            if result.successful():
+                uploaded[part_num] = result.get()
+    cancelled = None
+    for part_num in sorted(results):
+        try:
+            parts[part_num] = results[part_num].get()[0]
+        except CancelledError as e:
+            # cancelled because another part failed, which is the error to raise
+            if cancelled is None:
+                cancelled = e
+    if cancelled is not None:
+        raise cancelled
+    return [parts[part_num] for part_num in sorted(parts)], checksum.hexdigest()
+
+
+def upload_part(engine, mp, codec, buffers, buf, length, part_num, failed, throttle=None):
+    """
+    the part buffer goes back to the pool as soon as it is compressed,
+    failed uploads of the compressed part are retried by the engine
+
+    the parts still uploading are cancelled as soon as one of the parts
+    of the file fails
+
+    returns the [stored size, size] of the part and the md5 of what was uploaded
+    """
+    try:
+        if failed.is_set():
+            buffers.release(buf)
+            raise CancelledError('cancelled')
+        try:
+            chunk = codec.compress(buf, length)
+        finally:
+            buffers.release(buf)
+        if throttle is not None:
+            throttle.network(len(chunk))
+        engine.retry(upload_chunk, engine.multipart_upload(mp), chunk, part_num, failed)
+        return [len(chunk), length], hashlib.md5(chunk).hexdigest()
+    except Exception:
+        failed.set()
+        raise
+
+
+def upload_path(engine, source, s3_base_path, s3_ssenc, buffers, upload_index=None,
+                codec_name=DEFAULT_CODEC, codec_level=None, throttle=None, stat=None):
+    """
+    uploads a file unless the upload index shows it is already on S3,
+    returns the file index entry; stat is the one in the manifest if known
+    """
+    codec = codec_for_file(source, codec_name, codec_level)
+    destination = destination_path(s3_base_path, source, codec)
+    stat = stat or os.stat(source)
+    uploaded = upload_index is not None and upload_index.lookup(stat, destination)
+    if uploaded:
+        logger.info("%s already uploaded to %s" % (source, destination))
+        stored_size, etag, checksum, parts = uploaded
+    else:
+        parts, etag, checksum = upload_file(engine, source, destination, s3_ssenc, codec, buffers, throttle,
+                                            stat.st_size)
+        stored_size = sum(stored for stored, size in parts)
+        if upload_index is not None:
+            upload_index.record(source, stat, destination, etag, stored_size, checksum, parts)
+    return file_index_entry(source, destination, stat.st_size, stored_size, codec, checksum, parts)
+
+
+def upload_object(engine, source, s3_objects_path, s3_ssenc, buffers, upload_index=None,
+                  codec_name=DEFAULT_CODEC, codec_level=None, throttle=None, stat=None):
+    """
+    uploads a file to the content addressed object store unless an
+    identical object is already there, returns the file index entry;
+    stat is the one in the manifest if known
+    """
+    codec = codec_for_file(source, codec_name, codec_level)
+    stat = stat or os.stat(source)
+    checksum = upload_index is not None and upload_index.checksum(stat) or file_checksum(source, throttle)
+    destination = object_path(s3_objects_path, source, stat.st_size, checksum, codec)
+    uploaded = upload_index is not None and upload_index.lookup(stat, destination)
+    # objects are shared by the snapshots: the upload index can't tell
+    # whether the object was deleted since, S3 is asked every run
+    key = engine.retry(engine.bucket.get_key, destination)
+    if key is not None and uploaded:
+        stored_size, etag, _, parts = uploaded
+    else:
+        if key is None:
+            if uploaded:
+                logger.warn("%s was deleted from S3, uploading %s again" % (destination, source))
+            parts, etag = upload_file(engine, source, destination, s3_ssenc, codec, buffers, throttle,
+                                      stat.st_size)[:2]
+            stored_size = sum(stored for stored, size in parts)
+        else:
+            # stored by an earlier run, its part boundaries are unknown
+            logger.info("%s already stored as %s" % (source, destination))
+            stored_size, etag, parts = key.size, key.etag, None
+        if upload_index is not None:
+            upload_index.record(source, stat, destination, etag, stored_size, checksum, parts)
+    return file_index_entry(source, destination, stat.st_size, stored_size, codec, checksum, parts)
+
+
+def file_index_entry(source, destination, size, stored_size, codec, checksum, parts):
+    return {
+        'path': source,
+        'key': destination,
+        'size': size,
+        'stored_size': stored_size,
+        'codec': codec.name,
+        'checksum': checksum,
+        'parts': parts
+    }
+
+
+def write_file_index(engine, s3_base_path, entries, s3_ssenc):
+    def write():
+        key = engine.bucket.new_key(file_index_path(s3_base_path))
+        key.set_contents_from_string(json.dumps({'files': entries}), encrypt_key=s3_ssenc)
+    engine.retry(write)
+
+
+def upload_chunk(mp, chunk, index, cancelled=None):
+    """
+    a part has UPLOAD_TIMEOUT seconds to upload, setting the
+    cancelled event interrupts it
+    """
+    deadline = Deadline(UPLOAD_TIMEOUT, cancelled=cancelled)
+    mp.upload_part_from_file(DeadlineFile(StringIO(chunk), deadline), index)
 
 
 def cancel_upload(bucket, mp, remote_path):
     """
     safe way to cancel a multipart upload
     sleeps SLEEP_TIME seconds and then makes sure that there are not parts left
-    in storage
+    in storage, only the uploads of remote_path are listed
+
+    uploads S3 no longer knows are already cancelled, after MAX_RETRY_COUNT
+    failed attempts the upload is left to sweep-uploads
 
     """
-    while True:
+    for attempt in range(1, MAX_RETRY_COUNT + 1):
         try:
             time.sleep(SLEEP_TIME)
-            mp.cancel_upload()
+            abort_upload(mp)
             time.sleep(SLEEP_TIME)
-            for mp in bucket.list_multipart_uploads():
-                if mp.key_name == remote_path:
-                    mp.cancel_upload()
+            for upload in list_multipart_uploads(bucket, remote_path):
+                if upload.key_name == remote_path:
+                    abort_upload(upload)
             return
         except Exception:
-            logger.exception("Error while cancelling multipart upload")
+            logger.exception("Error while cancelling multipart upload (attempt %d of %d)" % (
+                attempt, MAX_RETRY_COUNT))
+    logger.error("Giving up cancelling multipart upload of %s" % remote_path)
+
+
+def abort_upload(mp):
+    try:
+        mp.cancel_upload()
+    except S3ResponseError as e:
+        if not upload_gone(e):
+            raise
 
 
 def put_from_manifest(s3_bucket, s3_connection_host, s3_ssenc, s3_base_path,
-                      aws_access_key_id, aws_secret_access_key, manifest, concurrency=None, incremental_backups=False):
+                      aws_access_key_id, aws_secret_access_key, manifest, concurrency=None, incremental_backups=False,
+                      s3_objects_path=None, upload_index_path=None, part_concurrency=DEFAULT_PART_CONCURRENCY,
+                      max_memory=None, codec_name=DEFAULT_CODEC, codec_level=None, throttle=None):
     """
     uploads files listed in a manifest to amazon S3
     to support larger than 5GB files multipart upload is used (chunks of 60MB)
     files are uploaded compressed with snappy, the .snappy suffix is appended
+    (or with the given codec and its own suffix)
+
+    concurrency files are read at the same time by threads of this process,
+    their chunks are compressed and uploaded by a TransferEngine: up to
+    concurrency * part_concurrency chunks are in flight, when max_memory (in bytes)
+    is given fewer chunks are kept in flight so that the whole run stays under it
+
+    files are uploaded largest first, see schedule_uploads
+
+    once all the files are uploaded an index listing them (with their S3 key,
+    size, stored size, codec, checksum and parts) is written under s3_base_path;
+    when s3_objects_path is given files are stored there by content and
+    only the index pointing to them is written under s3_base_path
+
+    completed uploads are recorded in a local index (by default next to the
+    manifest) so that a retried put only uploads what is still missing
+
+    throttle (a Throttle) limits the network and disk read rates of all
+    the concurrent uploads together
     """
-    bucket = get_bucket(s3_bucket, aws_access_key_id, aws_secret_access_key, s3_connection_host)
-    print bucket
-    manifest_fp = open(manifest, 'r')
-    files = manifest_fp.read().splitlines()
+    concurrency = concurrency or DEFAULT_CONCURRENCY
+    entries = read_upload_manifest(manifest)
+    files = [entry['path'] for entry in entries]
     print files
-    # pool = Pool(concurrency)
-    # for _ in pool.imap(upload_file_imap, ((bucket, f, destination_path(s3_base_path, f), s3_ssenc) for f in files)):
-    #     pass
-    # pool.terminate()
-
-    output = Parallel(n_jobs=concurrency)(
-        delayed(upload_file)(bucket, f, destination_path(s3_base_path, f), s3_ssenc)
-        for f in files)
+    upload_index = UploadIndex(upload_index_path or manifest + '.index')
+    if max_memory:
+        part_concurrency = memory_bounded_part_concurrency(max_memory, concurrency, part_concurrency)
+
+    engine = TransferEngine(s3_bucket, aws_access_key_id, aws_secret_access_key, s3_connection_host,
+                            max_in_flight=concurrency * part_concurrency)
+    buffers = BufferPool(concurrency * part_concurrency)
+
+    def upload(entry):
+        if s3_objects_path:
+            return upload_object(engine, entry['path'], s3_objects_path, s3_ssenc, buffers, upload_index,
+                                 codec_name, codec_level, throttle, entry_stat(entry))
+        return upload_path(engine, entry['path'], s3_base_path, s3_ssenc, buffers, upload_index,
+                           codec_name, codec_level, throttle, entry_stat(entry))
+
+    def upload_batch(batch):
+        return [upload(entry) for entry in batch]
+
+    # the threads reading files wait for the engine, they can't be engine requests
+    file_pool = Pool(concurrency)
+    index_entries = []
+    try:
+        # one batch at a time, so that the largest files are the first ones started
+        for batch_entries in file_pool.imap_unordered(upload_batch, schedule_uploads(entries)):
+            index_entries.extend(batch_entries)
+    finally:
+        file_pool.terminate()
+        file_pool.join()
+        engine.close()
+    write_file_index(engine, s3_base_path, index_entries, s3_ssenc)
 
     if incremental_backups:
         for f in files:
             os.remove(f)
 
 
+def schedule_uploads(entries):
+    """
+    returns the manifest entries in batches, in the order they should be uploaded
+
+    files are started largest first so that no large file is left running
+    alone at the end of the run; the chunks of the files being uploaded share
+    the buffers, a large file whose reading gets ahead of the others takes
+    the buffers (and the engine requests) the others leave idle.
+    Small files go last, SMALL_FILE_BATCH of them per batch.
+    """
+    entries = sorted(entries, key=lambda entry: entry['size'], reverse=True)
+    batches = [[entry] for entry in entries if entry['size'] > SMALL_FILE_SIZE]
+    small = [entry for entry in entries if entry['size'] <= SMALL_FILE_SIZE]
+    for i in range(0, len(small), SMALL_FILE_BATCH):
+        batches.append(small[i:i + SMALL_FILE_BATCH])
+    return batches
+
+
+def memory_bounded_part_concurrency(max_memory, concurrency, part_concurrency):
+    """
+    every part in flight holds a read buffer and (at most) as much
+    compressed data, spread max_memory across the concurrent files
+    """
+    available = max_memory / (concurrency * 2 * BUFFER_SIZE)
+    if available < 1:
+        logger.warn("max memory %d is too low for %d concurrent files, using one part per file" % (
+            max_memory, concurrency))
+        available = 1
+    return min(part_concurrency, available)
+
+
+class DirEntry(object):
+    """
+    What the manifest walker uses of the entries scandir yields,
+    for the pythons without scandir
+    """
+
+    def __init__(self, directory, name):
+        self.name = name
+        self.path = os.path.join(directory, name)
+
+    def is_dir(self):
+        return os.path.isdir(self.path)
+
+    def is_file(self):
+        return os.path.isfile(self.path)
+
+    def stat(self):
+        return os.stat(self.path)
+
+
+def scan_dir(path):
+    """
+    returns the entries of a directory, none when it does not exist
+    """
+    try:
+        if scandir is not None:
+            return list(scandir(path))
+        return [DirEntry(path, name) for name in os.listdir(path)]
+    except OSError as e:
+        if e.errno in (errno.ENOENT, errno.ENOTDIR):
+            return []
+        raise
+
+
+def manifest_entry(path, stat):
+    return {
+        'path': path,
+        'size': stat.st_size,
+        'mtime': stat.st_mtime,
+        'inode': stat.st_ino,
+        'component': sstable_component(os.path.basename(path))
+    }
+
+
+def entry_stat(entry):
+    """
+    the stat of a file as recorded in the manifest
+    """
+    return FileStat(entry['inode'], entry['size'], entry['mtime'])
+
+
+def keyspace_manifest_entries(keyspace_path, table_glob, snapshot_name, incremental_backups=False):
+    """
+    returns the manifest entries of the files of a keyspace to upload,
+    the files of the snapshot (or the incremental backups) of its tables
+    """
+    entries = []
+    for table in scan_dir(keyspace_path):
+        if table.name.startswith('.') or not fnmatch.fnmatch(table.name, table_glob) or not table.is_dir():
+            continue
+        if incremental_backups:
+            files_path = os.path.join(table.path, 'backups')
+        else:
+            files_path = os.path.join(table.path, 'snapshots', snapshot_name)
+        for entry in scan_dir(files_path):
+            if entry.name.startswith('.') or not entry.is_file():
+                continue
+            entries.append(manifest_entry(entry.path, entry.stat()))
+    return entries
+
+
 def create_upload_manifest(snapshot_name, snapshot_keyspaces, snapshot_table, data_path, manifest_path, incremental_backups=False):
+    """
+    writes the manifest of the files to upload, one json object per line
+    with the path, size, mtime, inode and sstable component of a file
+
+    keyspaces are walked in parallel by MANIFEST_CONCURRENCY threads, the
+    entries of each keyspace are written as soon as it is walked
+    """
     if snapshot_keyspaces:
         keyspace_globs = snapshot_keyspaces.split()
     else:
@@ -141,25 +707,82 @@ def create_upload_manifest(snapshot_name, snapshot_keyspaces, snapshot_table, da
     else:
         table_glob = '*'
 
-    files = []
-    for keyspace_glob in keyspace_globs:
-        path = [
-            data_path,
-            keyspace_glob,
-            table_glob
-        ]
-        if incremental_backups:
-            path += ['backups']
-        else:
-            path += ['snapshots', snapshot_name]
-        path += ['*']
+    keyspace_paths = [keyspace.path for keyspace in sorted(scan_dir(data_path), key=lambda keyspace: keyspace.name)
+                      if not keyspace.name.startswith('.') and keyspace.is_dir() and
+                      any(fnmatch.fnmatch(keyspace.name, keyspace_glob) for keyspace_glob in keyspace_globs)]
+
+    pool = Pool(MANIFEST_CONCURRENCY)
+    try:
+        with open(manifest_path, 'w') as manifest:
+            for entries in pool.imap_unordered(
+                    lambda keyspace_path: keyspace_manifest_entries(keyspace_path, table_glob, snapshot_name,
+                                                                    incremental_backups),
+                    keyspace_paths):
+                for entry in entries:
+                    manifest.write(json.dumps(entry) + '\n')
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def read_upload_manifest(manifest_path):
+    """
+    returns the entries of a manifest, the files of manifests listing
+    a path per line (written by older agents) are stat-ed
+    """
+    entries = []
+    with open(manifest_path) as manifest:
+        for line in manifest:
+            line = line.strip()
+            if not line:
+                continue
+            if line.startswith('{'):
+                entries.append(json.loads(line))
+            else:
+                entries.append(manifest_entry(line, os.stat(line)))
+    return entries
+
+
+def fetch_snapshot_files(s3_bucket, s3_base_path, aws_access_key_id, aws_secret_access_key, snapshot_name,
+                         source_host, keyspace, table, data_path, nodetool_path='nodetool', as_of=None):
+    """
+    restores the files source_host stored in a snapshot straight into the
+    table directories of this node's data_path and loads them with
+    nodetool refresh, the node must own the tokens source_host owned
+    """
+    s3_connection = S3Connection(aws_access_key_id, aws_secret_access_key)
+    bucket = s3_connection.get_bucket(s3_bucket, validate=False)
+    manifest = bucket.get_key('/'.join([s3_base_path, snapshot_name, 'manifest.json']))
+    snapshot = Snapshot.load_manifest_file(manifest.get_contents_as_string(), s3_bucket)
+    worker = RestoreWorker(aws_access_key_id=aws_access_key_id,
+                           aws_secret_access_key=aws_secret_access_key,
+                           snapshot=snapshot,
+                           data_path=data_path,
+                           nodetool_path=nodetool_path,
+                           as_of=as_of)
+    worker.restore(keyspace, table, [source_host], [])
+
 
-        path = os.path.join(*path)
-        glob_results = '\n'.join(glob.glob(os.path.join(path)))
-        files.extend([f.strip() for f in glob_results.split("\n")])
+def throttle_hours(value):
+    start, end = value.split('-')
+    return int(start), int(end)
 
-    with open(manifest_path, 'w') as manifest:
-        manifest.write('\n'.join("%s" % f for f in files))
+
+def get_throttle(args):
+    """
+    returns the Throttle of a put run, None without rate limits
+    """
+    if not args.max_network_rate and not args.max_disk_rate:
+        return None
+    node_load = None
+    if args.throttle_max_pending_compactions is not None or args.throttle_max_read_latency is not None:
+        node_load = NodeLoad(args.manifest + '.load', args.nodetool_path,
+                             args.throttle_max_pending_compactions, args.throttle_max_read_latency)
+    return Throttle(args.manifest + '.throttle',
+                    network_rate=args.max_network_rate and args.max_network_rate * 1024 * 1024,
+                    disk_rate=args.max_disk_rate and args.max_disk_rate * 1024 * 1024,
+                    hours=args.throttle_hours,
+                    node_load=node_load)
 
 
 def main():
@@ -169,6 +792,7 @@ def main():
 
     put_parser = subparsers.add_parser('put', help='put files on s3 from a manifest')
     manifest_parser = subparsers.add_parser('create-upload-manifest', help='put files on s3 from a manifest')
+    fetch_parser = subparsers.add_parser('fetch', help='restore the files of a snapshot into the data path')
 
     # put arguments
     put_parser = add_s3_arguments(put_parser)
@@ -180,7 +804,81 @@ def main():
                             required=False,
                             default=DEFAULT_CONCURRENCY,
                             type=int,
-                            help='Compress and upload concurrent processes')
+                            help='Files uploaded concurrently')
+
+    put_parser.add_argument('--part-concurrency',
+                            required=False,
+                            default=DEFAULT_PART_CONCURRENCY,
+                            type=int,
+                            help='Chunks in flight per file uploaded concurrently, a large file can take the '
+                                 'share of the others (each chunk holds up to 60MB in memory)')
+
+    put_parser.add_argument('--max-memory',
+                            required=False,
+                            default=None,
+                            type=int,
+                            help='Upper bound (in MB) of the memory used for file chunks '
+                                 'by all the concurrent uploads')
+
+    put_parser.add_argument('--codec',
+                            required=False,
+                            default=DEFAULT_CODEC,
+                            choices=CODECS,
+                            help='Compression codec; auto stores sstables already compressed by '
+                                 'cassandra as they are and compresses the rest with snappy')
+
+    put_parser.add_argument('--codec-level',
+                            required=False,
+                            default=None,
+                            type=int,
+                            help='Compression level (zstd only)')
+
+    put_parser.add_argument('--dedup-base-path',
+                            required=False,
+                            default=None,
+                            help='S3 base path of the content addressed object store; '
+                                 'files already stored there are not uploaded again')
+
+    put_parser.add_argument('--upload-index',
+                            required=False,
+                            default=None,
+                            help='Local index of the files already uploaded from this node '
+                                 '(default: <manifest>.index)')
+
+    put_parser.add_argument('--max-network-rate',
+                            required=False,
+                            default=None,
+                            type=float,
+                            help='Upper bound (in MB/s) of the upload rate of all the concurrent uploads')
+
+    put_parser.add_argument('--max-disk-rate',
+                            required=False,
+                            default=None,
+                            type=float,
+                            help='Upper bound (in MB/s) of the disk read rate of all the concurrent uploads')
+
+    put_parser.add_argument('--throttle-hours',
+                            required=False,
+                            default=None,
+                            type=throttle_hours,
+                            help='Only enforce the rates between these local hours, e.g. 8-20')
+
+    put_parser.add_argument('--throttle-max-pending-compactions',
+                            required=False,
+                            default=None,
+                            type=int,
+                            help='Scale the rates down while the node has more pending compactions')
+
+    put_parser.add_argument('--throttle-max-read-latency',
+                            required=False,
+                            default=None,
+                            type=float,
+                            help='Scale the rates down while the p99 read latency (ms) of the node is higher')
+
+    put_parser.add_argument('--nodetool-path',
+                            required=False,
+                            default='nodetool',
+                            help='nodetool used to read the node load')
 
     # create-upload-manifest arguments
     manifest_parser.add_argument('--snapshot_name', required=True, type=str)
@@ -189,9 +887,27 @@ def main():
     manifest_parser.add_argument('--data_path', required=True, type=str)
     manifest_parser.add_argument('--manifest_path', required=True, type=str)
 
+    # fetch arguments
+    fetch_parser = add_s3_arguments(fetch_parser)
+    fetch_parser.add_argument('--snapshot-name', required=True, type=str)
+    fetch_parser.add_argument('--source-host',
+                              required=True,
+                              help='The host of the snapshot whose files are restored')
+    fetch_parser.add_argument('--keyspace', required=True, type=str)
+    fetch_parser.add_argument('--table', required=False, default='', type=str)
+    fetch_parser.add_argument('--data-path', required=True, type=str)
+    fetch_parser.add_argument('--nodetool-path', required=False, default='nodetool', type=str)
+    fetch_parser.add_argument('--as-of',
+                              required=False,
+                              default=None,
+                              type=lambda value: datetime.strptime(value, Snapshot.SNAPSHOT_TIMESTAMP_FORMAT),
+                              help='Only restore the files uploaded by this (UTC) time')
+
     args = base_parser.parse_args()
     subcommand = args.subcommand
 
+    set_socket_timeout(args.socket_timeout)
+
     if subcommand == 'create-upload-manifest':
         create_upload_manifest(
             args.snapshot_name,
@@ -212,7 +928,29 @@ def main():
             args.aws_secret_access_key,
             args.manifest,
             args.concurrency,
-            args.incremental_backups
+            args.incremental_backups,
+            args.dedup_base_path,
+            args.upload_index,
+            args.part_concurrency,
+            args.max_memory and args.max_memory * 1024 * 1024,
+            args.codec,
+            args.codec_level,
+            get_throttle(args)
+        )
+
+    if subcommand == 'fetch':
+        fetch_snapshot_files(
+            args.s3_bucket_name,
+            args.s3_base_path,
+            args.aws_access_key_id,
+            args.aws_secret_access_key,
+            args.snapshot_name,
+            args.source_host,
+            args.keyspace,
+            args.table,
+            args.data_path,
+            args.nodetool_path,
+            args.as_of
         )
 
 if __name__ == '__main__':
@@ -0,0 +1,174 @@
+"""
+Compression codecs of the files stored on S3
+
+Files are uploaded in parts, every part is compressed on its own as a
+complete stream (or frame) so that parts can be compressed in parallel;
+the concatenation of the parts is what ends up on S3.
+
+The codec of an object is recorded by the suffix of its key, restores
+pick the matching decompressor from the key name.
+"""
+import os
+import snappy
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+
+CODECS = ['auto', 'snappy', 'zstd', 'lz4', 'none']
+DEFAULT_CODEC = 'snappy'
+DEFAULT_ZSTD_LEVEL = 3
+
+
+class CodecError(Exception):
+    pass
+
+
+class FramesDecompressor(object):
+    """
+    Decompresses a sequence of concatenated frames, a new
+    decompressor is started at the end of every frame
+    """
+
+    def __init__(self, factory):
+        self._factory = factory
+        self._decompressor = factory()
+        self._pending = False
+
+    def decompress(self, data):
+        output = []
+        while data:
+            output.append(self._decompressor.decompress(data))
+            self._pending = not self._decompressor.eof
+            if self._pending:
+                break
+            data = self._decompressor.unused_data
+            self._decompressor = self._factory()
+        return b''.join(output)
+
+    def flush(self):
+        if self._pending:
+            raise CodecError('truncated compressed stream')
+
+
+class PassthroughDecompressor(object):
+
+    def decompress(self, data):
+        return data
+
+    def flush(self):
+        pass
+
+
+class SnappyCodec(object):
+    name = 'snappy'
+    suffix = '.snappy'
+
+    def compress(self, buf, length):
+        # python 2 snappy bindings read old style buffers only
+        return snappy.StreamCompressor().add_chunk(buffer(buf, 0, length))
+
+    def decompressor(self):
+        return snappy.StreamDecompressor()
+
+
+class ZstdCodec(object):
+    name = 'zstd'
+    suffix = '.zst'
+
+    def __init__(self, level=None):
+        if zstandard is None:
+            raise CodecError('zstd compression requires the zstandard package')
+        self.level = level or DEFAULT_ZSTD_LEVEL
+
+    def compress(self, buf, length):
+        return zstandard.ZstdCompressor(level=self.level).compress(memoryview(buf)[:length])
+
+    def decompressor(self):
+        return FramesDecompressor(lambda: zstandard.ZstdDecompressor().decompressobj())
+
+
+class Lz4Codec(object):
+    name = 'lz4'
+    suffix = '.lz4'
+
+    def __init__(self):
+        if lz4 is None:
+            raise CodecError('lz4 compression requires the lz4 package')
+
+    def compress(self, buf, length):
+        return lz4.frame.compress(memoryview(buf)[:length])
+
+    def decompressor(self):
+        return FramesDecompressor(lz4.frame.LZ4FrameDecompressor)
+
+
+class PassthroughCodec(object):
+    name = 'none'
+    suffix = ''
+
+    def compress(self, buf, length):
+        # a copy: the buffer is reused as soon as the part is "compressed"
+        return bytes(buffer(buf, 0, length))
+
+    def decompressor(self):
+        return PassthroughDecompressor()
+
+
+def get_codec(name, level=None):
+    if name == 'snappy':
+        return SnappyCodec()
+    if name == 'zstd':
+        return ZstdCodec(level)
+    if name == 'lz4':
+        return Lz4Codec()
+    if name == 'none':
+        return PassthroughCodec()
+    raise CodecError('unknown codec %s' % name)
+
+
+def is_compressed_sstable(path):
+    """
+    Data.db components of the tables with compression enabled
+    come with a CompressionInfo.db component
+    """
+    if not path.endswith('Data.db'):
+        return False
+    return os.path.exists(path[:-len('Data.db')] + 'CompressionInfo.db')
+
+
+def codec_for_file(path, name, level=None):
+    """
+    auto stores compressed sstables as they are and
+    compresses everything else with the default codec
+    """
+    if name == 'auto':
+        if is_compressed_sstable(path):
+            return PassthroughCodec()
+        return get_codec(DEFAULT_CODEC, level)
+    return get_codec(name, level)
+
+
+def _codec_class_for_key(key_name):
+    for codec_class in (SnappyCodec, ZstdCodec, Lz4Codec):
+        if key_name.endswith(codec_class.suffix):
+            return codec_class
+    return PassthroughCodec
+
+
+def codec_for_key(key_name):
+    return get_codec(_codec_class_for_key(key_name).name)
+
+
+def strip_codec_suffix(key_name):
+    suffix = _codec_class_for_key(key_name).suffix
+    if suffix:
+        return key_name[:-len(suffix)]
+    return key_name
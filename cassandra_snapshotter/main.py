@@ -1,9 +1,16 @@
 from collections import defaultdict
+from datetime import datetime, timedelta
+import argparse
 import socket
 import logging
 from fabric.api import env
 from fabric.operations import run, local
-from snapshotting import BackupWorker, RestoreWorker, Snapshot, SnapshotCollection
+from compression import CODECS, DEFAULT_CODEC
+from snapshotting import BackupWorker, DirectRestoreWorker, RestoreWorker, Snapshot, SnapshotCollection
+from snapshotting import CATALOG_CACHE_DIR, DECOMPRESS_PROCESSES, DOWNLOAD_CONCURRENCY, DOWNLOAD_PART_CONCURRENCY
+from snapshotting import LOADER_CONCURRENCY, MAX_DOWNLOAD_CONCURRENCY, MAX_RETRY_COUNT
+from timeout import set_socket_timeout
+from transfer import SWEEP_CONCURRENCY, SWEEP_OLDER_THAN, TransferEngine, sweep_multipart_uploads
 from utils import add_s3_arguments, get_s3_connection_host
 from utils import base_parser as _base_parser
 
@@ -11,7 +18,61 @@ from utils import base_parser as _base_parser
 env.use_ssh_config = True
 
 
-def run_backup(args):
+def catalog_cache_dir(args):
+    if args.no_catalog_cache:
+        return None
+    return args.catalog_cache_dir
+
+
+def add_node_arguments(arg_parser):
+    """
+    adds the arguments of the commands running on the cassandra nodes
+    """
+    arg_parser.add_argument('--cassandra-data-path',
+                            default='/var/lib/cassandra/data/',
+                            help='cassandra data path.')
+
+    arg_parser.add_argument('--cassandra-bin-dir',
+                            default='/usr/bin',
+                            help='cassandra binaries directory')
+
+    arg_parser.add_argument('--nodetool-path',
+                            default=None,
+                            help='nodetool path.')
+
+    arg_parser.add_argument('--agent-path',
+                            default=None,
+                            help='path of cassandra-snapshotter-agent on nodes')
+
+    arg_parser.add_argument('--agent-virtualenv',
+                            default=None,
+                            help='python virtualenv to run cassandra-snapshotter-agent in on nodes')
+
+    arg_parser.add_argument('--user',
+                            help='the ssh user to logging on nodes')
+
+    arg_parser.add_argument('--sshport',
+                            help='the ssh port to use to connect to the nodes')
+
+    arg_parser.add_argument('--sshkey',
+                            help='the file containing the private ssh key to use to connect to the nodes')
+
+    arg_parser.add_argument('--password',
+                            default='',
+                            help='user password to connect with hosts')
+
+    arg_parser.add_argument('--no-sudo',
+                            action='store_true',
+                            help='Do not use \'sudo\' when executing commands on the cassandra nodes')
+
+    arg_parser.add_argument('--connection-pool-size',
+                            default=12,
+                            help='Number of simultaneous connections to cassandra nodes.')
+
+    return arg_parser
+
+
+def configure_nodes(args, hosts):
     if args.user:
         env.user = args.user
 
@@ -24,12 +85,25 @@ def run_backup(args):
     if args.sshkey:
         env.key_filename = args.sshkey
 
+    env.hosts = hosts
+    env.run = run
+
+
+def as_of_time(value):
+    for time_format in (Snapshot.SNAPSHOT_TIMESTAMP_FORMAT, '%Y-%m-%dT%H:%M:%S', '%Y-%m-%d %H:%M:%S'):
+        try:
+            return datetime.strptime(value, time_format)
+        except ValueError:
+            pass
+    raise argparse.ArgumentTypeError('%s is not a YYYYmmddHHMMSS or YYYY-mm-ddTHH:MM:SS time' % value)
+
+
+def run_backup(args):
     if not args.hosts:
-        env.hosts = [socket.gethostname()]
+        configure_nodes(args, [socket.gethostname()])
         env.run = lambda cmd: local(cmd, capture=True)
     else:
-        env.hosts = args.hosts.split(',')
-        env.run = run
+        configure_nodes(args, args.hosts.split(','))
 
     keep_new_snapshot = args.keep_new_snapshot
     delete_old_snapshots = args.delete_old_snapshots
@@ -53,7 +127,8 @@ def run_backup(args):
             args.aws_access_key_id,
             args.aws_secret_access_key,
             args.s3_base_path,
-            args.s3_bucket_name
+            args.s3_bucket_name,
+            cache_dir=catalog_cache_dir(args)
         ).get_snapshot_for(
             hosts=env.hosts,
             keyspaces=args.keyspaces,
@@ -74,7 +149,16 @@ def run_backup(args):
         connection_pool_size=args.connection_pool_size,
         agent_path=args.agent_path,
         agent_virtualenv=args.agent_virtualenv,
-        use_sudo=(not args.no_sudo)
+        use_sudo=(not args.no_sudo),
+        dedup=args.dedup,
+        codec=args.codec,
+        codec_level=args.codec_level,
+        max_network_rate=args.max_network_rate,
+        max_disk_rate=args.max_disk_rate,
+        throttle_hours=args.throttle_hours,
+        throttle_max_pending_compactions=args.throttle_max_pending_compactions,
+        throttle_max_read_latency=args.throttle_max_read_latency,
+        catalog_cache_dir=catalog_cache_dir(args)
     )
 
     if create_snapshot:
@@ -98,7 +182,8 @@ def list_backups(args):
         args.aws_access_key_id,
         args.aws_secret_access_key,
         args.s3_base_path,
-        args.s3_bucket_name
+        args.s3_bucket_name,
+        cache_dir=catalog_cache_dir(args)
     )
     path_snapshots = defaultdict(list)
 
@@ -109,7 +194,10 @@ def list_backups(args):
     for path, snapshots in path_snapshots.iteritems():
         print '-----------[%s]-----------' % path
         for snapshot in snapshots:
-            print '\t %r hosts:%r keyspaces:%r table:%r' % (snapshot, snapshot.hosts, snapshot.keyspaces, snapshot.table)
+            print '\t %r hosts:%r keyspaces:%r table:%r' % (snapshot, snapshot.hosts, snapshot.keyspaces, snapshot.table),
+            if snapshot.size is not None:
+                print 'files:%d size:%s' % (snapshot.files, RestoreWorker._human_size(snapshot.size)),
+            print
         print '------------------------' + '-' * len(path)
 
 
@@ -118,23 +206,18 @@ def restore_backup(args):
         args.aws_access_key_id,
         args.aws_secret_access_key,
         args.s3_base_path,
-        args.s3_bucket_name
+        args.s3_bucket_name,
+        cache_dir=catalog_cache_dir(args)
     )
 
     snapshot = None
 
     if not args.local_source or not args.hosts:
         if args.snapshot_name == 'LATEST':
-            snapshot = snapshots.get_latest()
+            snapshot = snapshots.get_latest(before=args.as_of)
         else:
             snapshot = snapshots.get_snapshot_by_name(args.backup_name)
 
-    worker = RestoreWorker(aws_access_key_id=args.aws_access_key_id,
-                           aws_secret_access_key=args.aws_secret_access_key,
-                           snapshot=snapshot,
-                           local_source=args.local_source,
-                           merge_dir=args.merge_dir)
-
     if args.hosts:
         hosts = args.hosts.split(',')
     else:
@@ -142,11 +225,59 @@ def restore_backup(args):
 
     target_hosts = args.target_hosts.split(',')
 
+    if args.direct:
+        configure_nodes(args, target_hosts)
+        worker = DirectRestoreWorker(
+            aws_access_key_id=args.aws_access_key_id,
+            aws_secret_access_key=args.aws_secret_access_key,
+            s3_bucket_region=args.s3_bucket_region,
+            cassandra_data_path=args.cassandra_data_path,
+            nodetool_path=args.nodetool_path,
+            cassandra_bin_dir=args.cassandra_bin_dir,
+            connection_pool_size=args.connection_pool_size,
+            agent_path=args.agent_path,
+            agent_virtualenv=args.agent_virtualenv,
+            use_sudo=(not args.no_sudo)
+        )
+        worker.restore(snapshot, args.keyspace, args.table, hosts, target_hosts, args.as_of)
+        return
+
+    worker = RestoreWorker(aws_access_key_id=args.aws_access_key_id,
+                           aws_secret_access_key=args.aws_secret_access_key,
+                           snapshot=snapshot,
+                           local_source=args.local_source,
+                           merge_dir=args.merge_dir,
+                           part_concurrency=args.download_part_concurrency,
+                           download_concurrency=args.download_concurrency,
+                           max_download_concurrency=args.adaptive_download_concurrency and args.max_download_concurrency,
+                           decompress_processes=args.decompress_processes,
+                           loader_concurrency=args.loader_concurrency,
+                           loader_retries=args.loader_retries,
+                           resume=args.resume,
+                           as_of=args.as_of)
+
     worker.restore(args.keyspace, args.table, hosts, target_hosts)
 
 
+def sweep_uploads(args):
+    prefix = args.s3_base_path.rstrip('/') + '/'
+    if args.snapshot_name:
+        prefix += args.snapshot_name.rstrip('/') + '/'
+    engine = TransferEngine(args.s3_bucket_name, args.aws_access_key_id, args.aws_secret_access_key,
+                            get_s3_connection_host(args.s3_bucket_region), max_in_flight=args.concurrency)
+    aborted, size = sweep_multipart_uploads(engine, prefix, timedelta(hours=args.older_than))
+    print 'aborted %d multipart uploads under %s, reclaimed %s' % (aborted, prefix, RestoreWorker._human_size(size))
+
+
 def main():
     base_parser = add_s3_arguments(_base_parser)
+    base_parser.add_argument('--catalog-cache-dir',
+                             default=CATALOG_CACHE_DIR,
+                             help='Local cache of the snapshot manifests (default %s)' % CATALOG_CACHE_DIR)
+    base_parser.add_argument('--no-catalog-cache',
+                             action='store_true',
+                             help='Always read the snapshot manifests from S3')
+
     subparsers = base_parser.add_subparsers(title='subcommands',
                                             dest='subcommand')
 
@@ -167,42 +298,7 @@ def main():
                                default='',
                                help='The table (column family) to backup')
 
-    backup_parser.add_argument('--cassandra-data-path',
-                               default='/var/lib/cassandra/data/',
-                               help='cassandra data path.')
-
-    backup_parser.add_argument('--cassandra-bin-dir',
-                               default='/usr/bin',
-                               help='cassandra binaries directory')
-
-    backup_parser.add_argument('--nodetool-path',
-                               default=None,
-                               help='nodetool path.')
-
-    backup_parser.add_argument('--agent-path',
-                               default=None,
-                               help='path of cassandra-snapshotter-agent on nodes')
-
-    backup_parser.add_argument('--agent-virtualenv',
-                               default=None,
-                               help='python virtualenv to run cassandra-snapshotter-agent in on nodes')
-
-    backup_parser.add_argument('--user',
-                               help='the ssh user to logging on nodes')
-
-    backup_parser.add_argument('--sshport',
-                               help='the ssh port to use to connect to the nodes')
-
-    backup_parser.add_argument('--sshkey',
-                               help='the file containing the private ssh key to use to connect to the nodes')
-
-    backup_parser.add_argument('--password',
-                               default='',
-                               help='user password to connect with hosts')
-
-    backup_parser.add_argument('--no-sudo',
-                               action='store_true',
-                               help='Do not use \'sudo\' when executing commands on the cassandra nodes')
+    add_node_arguments(backup_parser)
 
     backup_parser.add_argument('--new-snapshot',
                                action='store_true',
@@ -227,9 +323,45 @@ def main():
                                action='store_true',
                                help='Backup (thrift) schema of selected keyspaces')
 
-    backup_parser.add_argument('--connection-pool-size',
-                               default=12,
-                               help='Number of simultaneous connections to cassandra nodes.')
+    backup_parser.add_argument('--dedup',
+                               action='store_true',
+                               help='Store files by content in <s3-base-path>/_objects so that files unchanged '
+                                    'since a previous snapshot are not uploaded again')
+
+    backup_parser.add_argument('--codec',
+                               default=DEFAULT_CODEC,
+                               choices=CODECS,
+                               help='Compression codec of the uploaded files; auto stores sstables already '
+                                    'compressed by cassandra as they are and compresses the rest with snappy')
+
+    backup_parser.add_argument('--codec-level',
+                               default=None,
+                               type=int,
+                               help='Compression level (zstd only)')
+
+    backup_parser.add_argument('--max-network-rate',
+                               default=None,
+                               type=float,
+                               help='Upper bound (in MB/s) of the upload rate of every node')
+
+    backup_parser.add_argument('--max-disk-rate',
+                               default=None,
+                               type=float,
+                               help='Upper bound (in MB/s) of the disk read rate of the uploads of every node')
+
+    backup_parser.add_argument('--throttle-hours',
+                               default=None,
+                               help='Only enforce the rates between these local hours of the nodes, e.g. 8-20')
+
+    backup_parser.add_argument('--throttle-max-pending-compactions',
+                               default=None,
+                               type=int,
+                               help='Scale the rates of a node down while it has more pending compactions')
+
+    backup_parser.add_argument('--throttle-max-read-latency',
+                               default=None,
+                               type=float,
+                               help='Scale the rates of a node down while its p99 read latency (ms) is higher')
 
     # restore snapshot arguments
     restore_parser = subparsers.add_parser('restore', help='restores a snapshot')
@@ -248,12 +380,70 @@ def main():
     restore_parser.add_argument('--target-hosts',
                                 required=True,
                                 help="The comma separated list of hosts to restore into")
+    restore_parser.add_argument('--direct',
+                                action='store_true',
+                                help="Restore every target host straight into its data directories and load "
+                                     "with nodetool refresh, the target ring must own the snapshot's token ranges")
+    add_node_arguments(restore_parser)
     restore_parser.add_argument('--local-source',
                                 default=None,
                                 help="Local directory containing a version of the backups as generated by the snapshotter")
     restore_parser.add_argument('--merge-dir',
                                 default='.',
                                 help="Parent of the temp folder storing the merge SSTables of all backups")
+    restore_parser.add_argument('--as-of',
+                                type=as_of_time,
+                                default=None,
+                                help="Restore the data backed up by this (UTC) time: the latest snapshot taken "
+                                     "before it and the incremental backups uploaded up to it")
+    restore_parser.add_argument('--resume',
+                                action='store_true',
+                                help="Resume an interrupted restore from the journal it kept in the merge "
+                                     "directory, only the missing files are fetched")
+    restore_parser.add_argument('--download-concurrency',
+                                type=int,
+                                default=DOWNLOAD_CONCURRENCY,
+                                help="Files downloaded in parallel (default %d)" % DOWNLOAD_CONCURRENCY)
+    restore_parser.add_argument('--adaptive-download-concurrency',
+                                action='store_true',
+                                help="Adjust the files downloaded in parallel to the observed throughput, "
+                                     "errors and disk write time, starting from --download-concurrency")
+    restore_parser.add_argument('--max-download-concurrency',
+                                type=int,
+                                default=MAX_DOWNLOAD_CONCURRENCY,
+                                help="Upper bound of --adaptive-download-concurrency (default %d)" % MAX_DOWNLOAD_CONCURRENCY)
+    restore_parser.add_argument('--download-part-concurrency',
+                                type=int,
+                                default=DOWNLOAD_PART_CONCURRENCY,
+                                help="Parts of a large file downloaded in parallel (default %d)" % DOWNLOAD_PART_CONCURRENCY)
+    restore_parser.add_argument('--decompress-processes',
+                                type=int,
+                                default=DECOMPRESS_PROCESSES,
+                                help="Processes decompressing the downloaded files, 0 decompresses "
+                                     "in the download threads (default %d)" % DECOMPRESS_PROCESSES)
+    restore_parser.add_argument('--loader-concurrency',
+                                type=int,
+                                default=LOADER_CONCURRENCY,
+                                help="Tables loaded by sstableloader in parallel (default %d)" % LOADER_CONCURRENCY)
+    restore_parser.add_argument('--loader-retries',
+                                type=int,
+                                default=MAX_RETRY_COUNT,
+                                help="Times a failed sstableloader run is retried (default %d)" % MAX_RETRY_COUNT)
+
+    sweep_parser = subparsers.add_parser('sweep-uploads',
+                                         help='abort the multipart uploads left behind by failed or killed uploads')
+    sweep_parser.add_argument('--snapshot-name',
+                              default=None,
+                              help='Only sweep the uploads of this snapshot (default: the whole s3 base path)')
+    sweep_parser.add_argument('--older-than',
+                              default=SWEEP_OLDER_THAN.total_seconds() / 3600,
+                              type=float,
+                              help='Abort the uploads initiated more than this many hours ago '
+                                   '(default %d)' % (SWEEP_OLDER_THAN.total_seconds() / 3600))
+    sweep_parser.add_argument('--concurrency',
+                              default=SWEEP_CONCURRENCY,
+                              type=int,
+                              help='Uploads aborted in parallel (default %d)' % SWEEP_CONCURRENCY)
 
     args = base_parser.parse_args()
     subcommand = args.subcommand
@@ -261,12 +451,16 @@ def main():
     if args.verbose:
         logging.basicConfig(level=logging.INFO)
 
+    set_socket_timeout(args.socket_timeout)
+
     if subcommand == 'backup':
         run_backup(args)
     elif subcommand == 'list':
         list_backups(args)
     elif subcommand == 'restore':
         restore_backup(args)
+    elif subcommand == 'sweep-uploads':
+        sweep_uploads(args)
 
 if __name__ == '__main__':
     main()
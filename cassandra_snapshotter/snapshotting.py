@@ -1,5 +1,9 @@
+import fcntl
+import glob
 import re
 import shutil
+import socket
+import subprocess
 from boto.s3.connection import S3Connection
 from boto.s3.key import Key
 from boto.exception import S3ResponseError
@@ -9,36 +13,510 @@ from fabric.context_managers import settings, prefix
 from multiprocessing.dummy import Pool
 import json
 import logging
+import multiprocessing
 import os
+import threading
 import time
 import sys
-from snappy import StreamDecompressor
+from compression import codec_for_key, get_codec, strip_codec_suffix
+from timeout import Deadline
+from transfer import TransferEngine
+from utils import CATALOG_INDEX_NAME, FILE_INDEX_DIR, FILE_INDEX_TIME_FORMAT, OBJECTS_DIR, file_checksum
 
 MAX_RETRY_COUNT = 3
+DOWNLOAD_CONCURRENCY = 5
+MAX_DOWNLOAD_CONCURRENCY = 64
+DOWNLOAD_PART_CONCURRENCY = 4
+# seconds a part of a file has to download, stalled connections fail earlier (see --socket-timeout)
+PART_TIMEOUT = 600
+DECOMPRESS_PROCESSES = multiprocessing.cpu_count()
+DECOMPRESS_BLOCK_SIZE = 1048576
+LOADER_CONCURRENCY = 4
+LOADER_RETRY_DELAY = 10
+# ioctl cloning a file on copy on write filesystems (btrfs, xfs)
+FICLONE = 0x40049409
+# <version>-<generation>-[<format>-]<component> ending the name of sstable components
+SSTABLE_COMPONENT_RE = re.compile(r'([a-z]{2})-(\d+)-(?:[a-z]+-)?([^-]+)$')
+# files of cassandra snapshots that are not sstable components
+SNAPSHOT_METADATA_FILES = ('manifest.json', 'schema.cql')
+# adaptive download concurrency is reconsidered every interval
+ADAPTIVE_INTERVAL = 5.0
+# downloads spending more than this share of their time writing are disk bound
+DISK_BOUND_RATIO = 0.5
+MANIFEST_FETCH_CONCURRENCY = 16
+CATALOG_CACHE_DIR = os.path.join(
+    os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')), 'cassandra_snapshotter')
+# cached manifests are trusted for a day before asking S3 whether their etag changed
+CATALOG_REVALIDATE_AFTER = 86400
+# host: ring address of the nodes of a snapshot, next to its ring
+RING_ADDRESSES_NAME = 'ring_addresses.json'
 
 logger = logging.getLogger(__name__)
 
 
-def download_snappy_key(key, dst):
+class SSTableLoaderError(Exception):
+    pass
+
+
+class RingMismatchError(Exception):
+    pass
+
+
+class RestoreJournal(object):
+    """
+    Records, as JSON lines, the files a restore completed (with their size
+    and checksum) and the tables it loaded, so that an interrupted restore
+    can resume where it stopped
+
+    The first line identifies the restored snapshot and keyspace, a journal
+    of another restore is discarded.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.files = {}
+        self.tables = set()
+        self._lock = threading.Lock()
+        self._file_object = None
+
+    def open(self, source, keyspace, resume=False):
+        header = {'source': source, 'keyspace': keyspace}
+        if resume and self._load(header):
+            logging.info("Resuming restore: %d files done, %d tables loaded" % (len(self.files), len(self.tables)))
+            self._file_object = open(self.path, 'a')
+            return True
+        self.files = {}
+        self.tables = set()
+        self._file_object = open(self.path, 'w')
+        self._append(header)
+        return False
+
+    def _load(self, header):
+        if not os.path.exists(self.path):
+            return False
+        with open(self.path) as file_object:
+            lines = file_object.read().splitlines()
+        if not lines or json.loads(lines[0]) != header:
+            logging.warning("%s is the journal of another restore, starting over" % self.path)
+            return False
+        for line in lines[1:]:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # the last line of an interrupted restore may be incomplete
+                continue
+            if 'table' in entry:
+                self.tables.add(entry['table'])
+            else:
+                self.files[entry['path']] = entry
+        return True
+
+    def _append(self, entry):
+        with self._lock:
+            self._file_object.write(json.dumps(entry) + '\n')
+            self._file_object.flush()
+            os.fsync(self._file_object.fileno())
+
+    def is_complete(self, path):
+        entry = self.files.get(path)
+        return entry is not None and os.path.exists(path) and os.path.getsize(path) == entry['size']
+
+    def record_file(self, path, size, checksum):
+        self._append({'path': path, 'size': size, 'checksum': checksum})
+
+    def record_table(self, table):
+        self._append({'table': table})
+
+    def close(self):
+        if self._file_object is not None:
+            self._file_object.close()
+            self._file_object = None
+
+
+def parse_ring(ring_description):
+    """
+    returns the tokens owned by every address of a nodetool ring output
+    """
+    ring = {}
+    for line in ring_description.splitlines():
+        fields = line.split()
+        if len(fields) < 2 or not re.match(r'^-?\d+$', fields[-1]):
+            continue
+        ring.setdefault(fields[0], set()).add(int(fields[-1]))
+    return dict((address, frozenset(tokens)) for address, tokens in ring.items())
+
+
+def ring_address(addresses, ring):
+    """
+    returns the address in ring among the addresses of a node
+    (the output of hostname -I), None when the node is not in ring
+    """
+    for address in addresses:
+        if address in ring:
+            return address
+    return None
+
+
+def match_rings(source_ring, target_ring):
+    """
+    returns the target address owning the same tokens as every source
+    address, None when the two rings do not own the same token ranges
+    """
+    by_tokens = dict((tokens, address) for address, tokens in target_ring.items())
+    if len(by_tokens) != len(target_ring) or len(source_ring) != len(target_ring):
+        return None
+    matches = {}
+    for address, tokens in source_ring.items():
+        if tokens not in by_tokens:
+            return None
+        matches[address] = by_tokens[tokens]
+    return matches
+
+
+class ConcurrencyLimit(object):
+    """
+    Bounds the number of concurrent downloads
+
+    Downloads report the time spent writing to disk and their failed
+    attempts, so that subclasses can tune the limit while restoring.
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self._active = 0
+        self._condition = threading.Condition()
+
+    def acquire(self):
+        with self._condition:
+            while self._active >= self.limit:
+                self._condition.wait()
+            self._active += 1
+
+    def release(self, size=0, elapsed=0.0):
+        with self._condition:
+            self._active -= 1
+            self._downloaded(size, elapsed)
+            self._condition.notify_all()
+
+    def write(self, file_object, buf):
+        start = time.time()
+        file_object.write(buf)
+        self.record_write(time.time() - start)
+
+    def record_write(self, elapsed):
+        self._written(elapsed)
+
+    def failed(self):
+        with self._condition:
+            self._failed()
+
+    def _downloaded(self, size, elapsed):
+        pass
+
+    def _written(self, elapsed):
+        pass
+
+    def _failed(self):
+        pass
+
+
+class AdaptiveConcurrency(ConcurrencyLimit):
+    """
+    Adjusts the number of concurrent downloads to what the network
+    and the local disk sustain
+
+    Every interval the throughput of the last window is compared to the
+    one before: the limit grows by one while the throughput improves, is
+    halved when downloads fail and steps back by one when the throughput
+    drops or when writes take most of the download time (the disk, not
+    the network, is the bottleneck).
+    """
+
+    def __init__(self, limit, maximum=MAX_DOWNLOAD_CONCURRENCY, minimum=1, interval=ADAPTIVE_INTERVAL):
+        super(AdaptiveConcurrency, self).__init__(limit)
+        self.maximum = maximum
+        self.minimum = minimum
+        self.interval = interval
+        self._write_lock = threading.Lock()
+        self._last_throughput = None
+        self._reset(time.time())
+
+    def _reset(self, now):
+        self._window_start = now
+        self._bytes = 0
+        self._busy = 0.0
+        self._writing = 0.0
+        self._errors = 0
+
+    def _written(self, elapsed):
+        with self._write_lock:
+            self._writing += elapsed
+
+    def _failed(self):
+        self._errors += 1
+
+    def _downloaded(self, size, elapsed):
+        self._bytes += size
+        self._busy += elapsed
+        now = time.time()
+        if now - self._window_start >= self.interval:
+            self._adjust(now)
+
+    def _adjust(self, now):
+        throughput = self._bytes / (now - self._window_start)
+        with self._write_lock:
+            disk_bound = self._busy and self._writing / self._busy > DISK_BOUND_RATIO
+        limit = self.limit
+        if self._errors:
+            limit = limit // 2
+        elif disk_bound:
+            limit -= 1
+        elif self._last_throughput is None or throughput > self._last_throughput * 1.05:
+            limit += 1
+        elif throughput < self._last_throughput * 0.9:
+            limit -= 1
+        limit = max(self.minimum, min(self.maximum, limit))
+        if limit != self.limit:
+            logger.info("download concurrency %d -> %d (%s/s, %d errors%s)" % (
+                self.limit, limit, RestoreWorker._human_size(throughput), self._errors,
+                ', disk bound' if disk_bound else ''))
+            self.limit = limit
+        self._last_throughput = throughput
+        self._reset(now)
+
+
+class DecompressPool(object):
+    """
+    Decompresses downloaded parts in worker processes, out of the GIL of
+    the downloading threads
+
+    Parts are handed over whole and the workers write what they decompress
+    straight to the restored file, only the compressed bytes cross the pipe.
+    At most in_flight parts are held in memory at the same time.
+    """
+
+    def __init__(self, processes=DECOMPRESS_PROCESSES, in_flight=None):
+        self._pool = multiprocessing.Pool(processes)
+        self._slots = threading.BoundedSemaphore(in_flight or 2 * processes)
+
+    def decompress(self, codec_name, read, dst, offset):
+        """
+        reads a part with read() and decompresses it at offset of dst,
+        returns the number of bytes written and the time spent writing them
+        """
+        self._slots.acquire()
+        try:
+            data = read()
+            return self._pool.apply(write_decompressed, (codec_name, data, dst, offset))
+        finally:
+            self._slots.release()
+
+    def close(self):
+        self._pool.close()
+        self._pool.join()
+
+    def terminate(self):
+        self._pool.terminate()
+        self._pool.join()
+
+
+def write_decompressed(codec_name, data, dst, offset):
+    decompressor = get_codec(codec_name).decompressor()
+    buf = decompressor.decompress(data)
+    decompressor.flush()
+    start = time.time()
+    with open(dst, 'r+b') as file_object:
+        file_object.seek(offset)
+        file_object.write(buf)
+    return len(buf), time.time() - start
+
+
+def sstable_generation(filename):
+    """
+    returns the generation of an sstable component, None when the
+    file is not an sstable component numbered by generation
+    """
+    r = SSTABLE_COMPONENT_RE.search(strip_codec_suffix(filename))
+    if r:
+        return int(r.group(2))
+
+
+def sstable_component(filename):
+    """
+    returns the component (Data.db, Index.db, ...) of an sstable
+    file, None when the file is not an sstable component
+    """
+    r = SSTABLE_COMPONENT_RE.search(strip_codec_suffix(filename))
+    if r:
+        return r.group(3)
+
+
+def link_or_copy(src, dst):
+    """
+    restores a local file without copying its content when possible:
+    hard links it, reflinks it when it is on another filesystem (or links
+    are not allowed) and copies it as a last resort; returns which one it did
+
+    files compressed by a codec (named with its suffix) can't share their
+    content with the restored file, they are decompressed into dst
+    """
+    if os.path.lexists(dst):
+        os.remove(dst)
+    codec = codec_for_key(src)
+    if codec.suffix:
+        decompress_file(src, dst, codec)
+        return 'decompressed'
+    try:
+        os.link(src, dst)
+        return 'linked'
+    except OSError:
+        pass
+    try:
+        with open(src, 'rb') as src_file:
+            with open(dst, 'wb') as dst_file:
+                fcntl.ioctl(dst_file.fileno(), FICLONE, src_file.fileno())
+        shutil.copystat(src, dst)
+        return 'reflinked'
+    except (IOError, OSError):
+        pass
+    shutil.copy2(src, dst)
+    return 'copied'
+
+
+def decompress_file(src, dst, codec):
+    """
+    writes the content of the local file src, compressed with codec, to dst
+    """
+    decompressor = codec.decompressor()
+    with open(src, 'rb') as src_file:
+        with open(dst, 'wb') as dst_file:
+            while True:
+                data = src_file.read(DECOMPRESS_BLOCK_SIZE)
+                if not data:
+                    break
+                buf = decompressor.decompress(data)
+                if buf:
+                    dst_file.write(buf)
+    decompressor.flush()
+
+
+def _write(file_object, buf, monitor):
+    if monitor is None:
+        file_object.write(buf)
+    else:
+        monitor.write(file_object, buf)
+
+
+def download_key(engine, key, dst, part_concurrency=DOWNLOAD_PART_CONCURRENCY, monitor=None, decompress_pool=None):
+    """
+    downloads a key decompressing it with the codec its name ends with,
+    failed attempts are retried by the engine (a TransferEngine)
+
+    keys uploaded in several parts with known boundaries (see the parts of
+    the file indexes) are downloaded with ranged requests run by the engine
+    when part_concurrency allows more than one part at a time; with a
+    decompress_pool (a DecompressPool) their parts are decompressed by
+    worker processes
+
+    monitor (a ConcurrencyLimit) is told about disk writes and failed attempts
+    """
+    parts = getattr(key, 'parts', None)
+    if parts and (decompress_pool is not None or len(parts) > 1 and part_concurrency > 1):
+        return download_key_parts(engine, key, dst, parts, monitor, decompress_pool)
+
     logging.info("downloading %(key)s to %(filename)s" % dict(key=key.name, filename=dst))
-    retry_count = 0
-    while retry_count < MAX_RETRY_COUNT:
+    codec = codec_for_key(key.name)
+
+    def download_whole_key():
         try:
-            decompressor = StreamDecompressor()
+            decompressor = codec.decompressor()
             with open(dst, 'wb') as file_object:
-                for data in key:
+                for data in Key(engine.bucket, key.name):
                     buf = decompressor.decompress(data)
                     if buf:
-                        file_object.write(buf)
+                        _write(file_object, buf, monitor)
 
             decompressor.flush()
             return key.size
         except Exception:
-            logger.warn("Error downloading key {0} to {1}. Retry count: {2}".format(key.name, dst, retry_count))
-            retry_count += 1
-            if retry_count >= MAX_RETRY_COUNT:
-                logger.exception("Retried too many times uploading file")
-                raise
+            if monitor is not None:
+                monitor.failed()
+            logger.warn("Error downloading key {0} to {1}".format(key.name, dst))
+            raise
+
+    return engine.retry(download_whole_key)
+
+
+def download_key_parts(engine, key, dst, parts, monitor=None, decompress_pool=None):
+    """
+    downloads the [stored size, size] parts of a key in parallel,
+    every part is a complete compressed stream: it is decompressed
+    on its own and written at its offset in dst
+    """
+    logging.info("downloading %(key)s to %(filename)s in %(parts)d parts" % dict(
+        key=key.name, filename=dst, parts=len(parts)))
+    ranges = []
+    stored_offset = offset = 0
+    for stored_size, size in parts:
+        # empty files stored as they are have nothing to download
+        if stored_size:
+            ranges.append((stored_offset, stored_size, offset, size))
+        stored_offset += stored_size
+        offset += size
+
+    with open(dst, 'wb') as file_object:
+        file_object.truncate(offset)
+
+    results = [engine.submit(download_part, engine, key, dst, part_stored_offset, part_stored_size,
+                             part_offset, part_size, monitor, decompress_pool)
+               for part_stored_offset, part_stored_size, part_offset, part_size in ranges]
+    # dst is complete (or given up on) only once none of its parts is running
+    for result in results:
+        result.wait()
+    for result in results:
+        result.get()
+    return key.size
+
+
+def download_part(engine, key, dst, stored_offset, stored_size, offset, size, monitor=None, decompress_pool=None):
+    codec = codec_for_key(key.name)
+    headers = {'Range': 'bytes=%d-%d' % (stored_offset, stored_offset + stored_size - 1)}
+
+    def download_range():
+        try:
+            # keys keep the response they read from, every part needs its own
+            part_key = Key(engine.bucket, key.name)
+            part_key.open_read(headers=headers)
+            if decompress_pool is not None:
+                written, write_time = decompress_pool.decompress(codec.name, part_key.read, dst, offset)
+                if monitor is not None:
+                    monitor.record_write(write_time)
+            else:
+                written = _download_part_stream(part_key, codec, dst, offset, monitor, Deadline(PART_TIMEOUT))
+            if written != size:
+                raise IOError("part of %s at %d is %d bytes long, expected %d" % (key.name, offset, written, size))
+        except Exception:
+            if monitor is not None:
+                monitor.failed()
+            logger.warn("Error downloading part at {0} of key {1} to {2}".format(offset, key.name, dst))
+            raise
+
+    engine.retry(download_range)
+
+
+def _download_part_stream(part_key, codec, dst, offset, monitor, deadline):
+    decompressor = codec.decompressor()
+    written = 0
+    with open(dst, 'r+b') as file_object:
+        file_object.seek(offset)
+        for data in part_key:
+            deadline.check()
+            buf = decompressor.decompress(data)
+            if buf:
+                _write(file_object, buf, monitor)
+                written += len(buf)
+    decompressor.flush()
+    return written
 
 
 class Snapshot(object):
@@ -60,6 +538,23 @@ class Snapshot(object):
 
     Snapshots are represented on S3 by their manifest file, this makes incremental backups
     much easier
+
+    A summary of all the snapshots of a base path (see dump_index_entry) is kept in:
+
+        s3_bucket_name:/<base_path>/_index
+
+    Deduplicated snapshots store their files by content, once for all snapshots:
+
+        s3_bucket_name:/<base_path>/_objects/...
+
+    Every upload run of a node also writes the index of the files it uploaded
+    (S3 key, size, stored size, codec, checksum and parts), deduplicated snapshots only
+    keep these indexes:
+
+        s3_bucket_name:/<base_path>/<snapshot_name>/<node-hostname>/_files/<run>.json
+
+    Restores of snapshots with file indexes (file_indexes is set) plan from the
+    indexes instead of listing all the snapshot files.
     """
 
     SNAPSHOT_TIMESTAMP_FORMAT = '%Y%m%d%H%M%S'
@@ -71,6 +566,11 @@ class Snapshot(object):
         self.keyspaces = keyspaces
         self.table = table
         self._base_path = base_path
+        self.size = None
+        self.files = None
+        # host: the last file index counted in size and files
+        self.counted_indexes = None
+        self.file_indexes = True
 
     def dump_manifest_file(self):
         manifest_data = {
@@ -78,7 +578,8 @@ class Snapshot(object):
             'base_path': self._base_path,
             'hosts': self.hosts,
             'keyspaces': self.keyspaces,
-            'table': self.table
+            'table': self.table,
+            'file_indexes': self.file_indexes
         }
         return json.dumps(manifest_data)
 
@@ -93,12 +594,39 @@ class Snapshot(object):
             table=manifest_data['table']
         )
         snapshot.name = manifest_data['name']
+        snapshot.file_indexes = manifest_data.get('file_indexes', False)
+        return snapshot
+
+    def dump_index_entry(self):
+        return json.dumps({
+            'name': self.name,
+            'base_path': self._base_path,
+            'hosts': self.hosts,
+            'keyspaces': self.keyspaces,
+            'table': self.table,
+            'file_indexes': self.file_indexes,
+            'size': self.size,
+            'files': self.files,
+            'counted_indexes': self.counted_indexes
+        })
+
+    @staticmethod
+    def load_index_entry(data, s3_bucket):
+        snapshot = Snapshot.load_manifest_file(data, s3_bucket)
+        entry = json.loads(data)
+        snapshot.size = entry.get('size')
+        snapshot.files = entry.get('files')
+        snapshot.counted_indexes = entry.get('counted_indexes')
         return snapshot
 
     @property
     def base_path(self):
         return '/'.join([self._base_path, self.name])
 
+    @property
+    def objects_path(self):
+        return '/'.join([self._base_path, OBJECTS_DIR])
+
     def make_snapshot_name(self):
         return datetime.utcnow().strftime(self.SNAPSHOT_TIMESTAMP_FORMAT)
 
@@ -116,19 +644,79 @@ class Snapshot(object):
 
 
 class RestoreWorker(object):
-    def __init__(self, aws_access_key_id, aws_secret_access_key, snapshot, local_source='', merge_dir='.'):
+    def __init__(self, aws_access_key_id, aws_secret_access_key, snapshot, local_source='', merge_dir='.',
+                 part_concurrency=DOWNLOAD_PART_CONCURRENCY, download_concurrency=DOWNLOAD_CONCURRENCY,
+                 max_download_concurrency=None, decompress_processes=DECOMPRESS_PROCESSES,
+                 loader_concurrency=LOADER_CONCURRENCY, loader_retries=MAX_RETRY_COUNT,
+                 data_path=None, nodetool_path='nodetool', resume=False, as_of=None):
+        """
+        downloads run download_concurrency at a time, with max_download_concurrency
+        the concurrency adapts between 1 and max_download_concurrency
+        (see AdaptiveConcurrency) starting from download_concurrency
+
+        files with known parts are decompressed by decompress_processes
+        worker processes, 0 decompresses in the downloading threads
+
+        tables are loaded as soon as all their files are downloaded,
+        loader_concurrency at a time, failed loads are retried loader_retries times
+
+        with a data_path files are restored straight into the table directories
+        of the local cassandra data_path and loaded with nodetool refresh
+        (agent fetch, see DirectRestoreWorker), instead of going through merge_dir and
+        sstableloader
+
+        restores into merge_dir keep a journal of the files they completed,
+        with resume an interrupted restore only fetches the missing files
+
+        with as_of (an utc datetime) only the files uploaded by then are restored
+        and incremental backups already covered by the snapshot are skipped,
+        see _select_as_of
+
+        S3 requests go through a TransferEngine with room for part_concurrency
+        parts of every file downloaded at the same time
+        """
 
+        self.engine = None
         if not local_source:
             self.aws_secret_access_key = aws_secret_access_key
             self.aws_access_key_id = aws_access_key_id
-            self.s3connection = S3Connection(aws_access_key_id=self.aws_access_key_id,
-                                             aws_secret_access_key=self.aws_secret_access_key)
+            self.engine = TransferEngine(snapshot.s3_bucket, aws_access_key_id, aws_secret_access_key,
+                                         max_in_flight=(max_download_concurrency or download_concurrency) *
+                                         part_concurrency)
 
         self.snapshot = snapshot
         self.keyspace_table_matcher = None
+        self.file_index_matcher = None
+
+        self.keyspace = None
+        self.tables = set()
+        self.found_files = 0
+        self.found_size = 0
+        self.planned = False
 
         self.local_source = local_source
         self.merge_dir = merge_dir
+        self.data_path = data_path
+        self.nodetool_path = nodetool_path
+        self.table_dirs = {}
+        self.planned_files = set()
+        self.resume = resume
+        self.as_of = as_of
+        self.journal = None
+        self.transferred_tables = set()
+        self.part_concurrency = part_concurrency
+        self.download_concurrency = download_concurrency
+        self.max_download_concurrency = max_download_concurrency
+        self.concurrency = None
+        self.decompress_processes = decompress_processes
+        self.decompress_pool = None
+        self.loader_concurrency = loader_concurrency
+        self.loader_retries = loader_retries
+        self.loader_pool = None
+        self.target_hosts = None
+        self.pending = {}
+        self.loads = {}
+        self._tables_lock = threading.Lock()
 
         self.path_separator = os.path.sep
 
@@ -137,51 +725,173 @@ class RestoreWorker(object):
         self._restore(keyspace, table, hosts, target_hosts)
 
     def _find_local_keys(self):
+        """
+        yields the (name, path) of the local files to restore
+        """
+        for root, dirs, files in os.walk(self.local_source):
+            for filename in files:
+                fp = os.path.join(root, filename)
+                if self.keyspace_table_matcher.search(fp):
+                    yield fp, fp
 
-        def list_files(path):
-            bucket_files = []
-            for root, dirs, files in os.walk(path):
-                for filename in files:
-                    fp = os.path.join(root, filename)
-                    bucket_files.append(fp)
-
-            return bucket_files
+    def _find_s3_keys(self, hosts):
+        """
+        yields the (name, key) of the S3 keys to restore as they are listed
+        """
+        bucket = self.engine.bucket
 
-        bucket_list = list_files(self.local_source)
+        if self.snapshot.file_indexes:
+            for item in self._find_indexed_keys(bucket, hosts):
+                yield item
+            return
 
-        keys = []
-        tables = set()
+        for item in self._list_keys(bucket, self.snapshot.base_path):
+            yield item
 
-        for key_name in bucket_list:
-            r = self.keyspace_table_matcher.search(key_name)
-            if not r:
+    def _list_keys(self, bucket, prefix):
+        """
+        lists all the files under prefix, reading the file indexes found
+        """
+        for key in bucket.list(prefix):
+            r = self.file_index_matcher.search(key.name)
+            if r:
+                for item in self._read_file_index(bucket, key, r.group(1)):
+                    yield item
                 continue
 
-            tables.add(r.group(3))
-            keys.append(key_name)
+            if self.keyspace_table_matcher.search(key.name):
+                yield key.name, key
 
-        total_size = reduce(lambda s, k: s + os.path.getsize(k), keys, 0)
-
-        return keys, tables, total_size
-
-    def _find_s3_keys(self):
+    def _find_indexed_keys(self, bucket, hosts):
+        """
+        plans the restore from the file indexes of the nodes,
+        only the indexes are listed
 
-        bucket = self.s3connection.get_bucket(self.snapshot.s3_bucket, validate=False)
+        the files of nodes without file indexes (their agent
+        predates them) are listed instead
+        """
+        for host in hosts:
+            index_prefix = '/'.join([self.snapshot.base_path, host, FILE_INDEX_DIR, ''])
+            indexed = False
+            for index_key in bucket.list(index_prefix):
+                indexed = True
+                for item in self._read_file_index(bucket, index_key, host):
+                    yield item
+            if not indexed:
+                logging.warn("No file index for %(host)s in %(snapshot)s, listing its files" % dict(
+                    host=host, snapshot=self.snapshot))
+                for item in self._list_keys(bucket, '/'.join([self.snapshot.base_path, host, ''])):
+                    yield item
 
-        keys = []
-        tables = set()
+    @staticmethod
+    def file_index_time(index_key_name):
+        run_name = index_key_name.split('/')[-1][:-len('.json')]
+        return datetime.strptime(run_name, FILE_INDEX_TIME_FORMAT)
 
-        for key in bucket.list(self.snapshot.base_path):
-            r = self.keyspace_table_matcher.search(key.name)
-            if not r:
+    def _read_file_index(self, bucket, index_key, host):
+        """
+        yields the name the file would have had in the snapshot
+        together with the object storing its content
+        """
+        node_path = '/'.join([self.snapshot.base_path, host])
+        uploaded = self.file_index_time(index_key.name)
+        file_index = json.loads(self.engine.retry(index_key.get_contents_as_string))
+        for entry in file_index['files']:
+            name = '/'.join([node_path, entry['path']])
+            if not self.keyspace_table_matcher.search(name):
                 continue
+            object_key = Key(bucket, entry['key'])
+            object_key.size = entry['stored_size']
+            object_key.parts = entry.get('parts')
+            object_key.checksum = entry.get('checksum')
+            object_key.uploaded = uploaded
+            yield name, object_key
+
+    def _upload_time(self, source):
+        if self.local_source:
+            return datetime.utcfromtimestamp(os.path.getmtime(source))
+        uploaded = getattr(source, 'uploaded', None)
+        if uploaded is None:
+            uploaded = datetime.strptime(source.last_modified[:19], '%Y-%m-%dT%H:%M:%S')
+        return uploaded
+
+    def _select_as_of(self, items):
+        """
+        keeps the incremental backups uploaded up to as_of (put runs are dated
+        by their file index, the others by their S3 or local modification time)
 
-            tables.add(r.group(3))
-            keys.append(key)
+        the files of the snapshot itself are all kept: the snapshot was taken
+        before as_of, its upload may still have finished after it
 
-        total_size = reduce(lambda s, k: s + k.size, keys, 0)
+        sstable generations only grow: incremental backups of a table with
+        a generation lower than the newest sstable of the snapshot were
+        flushed before the snapshot, their data is in the snapshot either
+        as is or compacted, they are skipped
 
-        return keys, tables, total_size
+        all the files are listed before any is restored
+        """
+        selected = []
+        newest = {}
+        later = 0
+        for name, source in items:
+            if '/backups/' in name and self._upload_time(source) > self.as_of:
+                later += 1
+                continue
+            selected.append((name, source))
+            if '/snapshots/' in name:
+                r = self.keyspace_table_matcher.search(name)
+                generation = sstable_generation(name.split(self.path_separator)[-1])
+                if generation is not None:
+                    table = (r.group(1), r.group(3))
+                    newest[table] = max(newest.get(table, generation), generation)
+
+        covered = 0
+        for name, source in selected:
+            if '/backups/' in name:
+                r = self.keyspace_table_matcher.search(name)
+                generation = sstable_generation(name.split(self.path_separator)[-1])
+                if generation is not None and generation <= newest.get((r.group(1), r.group(3)), -1):
+                    covered += 1
+                    continue
+            yield name, source
+        logging.info("Restoring as of %(as_of)s: skipped %(later)d incremental backups uploaded later and %(covered)d "
+                     "incremental backups covered by the snapshot" % dict(as_of=self.as_of, later=later,
+                                                                          covered=covered))
+
+    def _plan(self, items):
+        """
+        creates the table directories of the files to restore as they are
+        found and keeps count of what has been found so far
+        """
+        for name, source in items:
+            r = self.keyspace_table_matcher.search(name)
+            table = r.group(3)
+            # sstables are immutable, the same file found in a snapshot
+            # and in incremental backups is restored once
+            filename = strip_codec_suffix(name.split(self.path_separator)[-1])
+            if (r.group(1), table, filename) in self.planned_files:
+                continue
+            self.planned_files.add((r.group(1), table, filename))
+            if self.data_path and filename in SNAPSHOT_METADATA_FILES:
+                continue
+            with self._tables_lock:
+                if table not in self.tables:
+                    if not self.data_path:
+                        path = os.path.join(self.merge_dir, self.keyspace, table)
+                        if not os.path.exists(path):
+                            os.makedirs(path)
+                    self.tables.add(table)
+                    self.pending[table] = 0
+                self.pending[table] += 1
+            self.found_size += self._source_size(source)
+            self.found_files += 1
+            yield name, source
+        with self._tables_lock:
+            self.planned = True
+            self._load_downloaded_tables()
+        logging.info("Found %(files_count)d files, with total size of %(size)s." % dict(
+            files_count=self.found_files,
+            size=self._human_size(self.found_size)))
 
     def _restore(self, keyspace, table, hosts, target_hosts):
         # TODO:
@@ -194,33 +904,61 @@ class RestoreWorker(object):
 
         matcher_string = "(%(hosts)s).*/(%(keyspace)s)/(%(table)s)/" % dict(hosts='|'.join(hosts), keyspace=keyspace, table=table)
         self.keyspace_table_matcher = re.compile(matcher_string)
+        self.file_index_matcher = re.compile("/(%(hosts)s)/%(file_index_dir)s/[^/]+\\.json$" % dict(
+            hosts='|'.join(hosts), file_index_dir=FILE_INDEX_DIR))
 
         if self.local_source:
             logging.info("Restoring keyspace=%(keyspace)s, table=%(table)s, "
                          "from existing local data: %(local_dir)s " % dict(keyspace=keyspace,
                                                                            table=table, local_dir=self.local_source))
 
-            keys, tables, total_size = self._find_local_keys()
+            keys = self._find_local_keys()
 
         else:
             logging.info("Restoring keyspace=%(keyspace)s, table=%(table)s" % dict(keyspace=keyspace,
                                                                                    table=table))
 
-            keys, tables, total_size = self._find_s3_keys()
-
-        self._delete_old_dir_and_create_new(keyspace, tables)
+            keys = self._find_s3_keys(hosts)
+
+        if self.as_of:
+            keys = self._select_as_of(keys)
+
+        self.journal = None
+        if not self.data_path:
+            if not os.path.exists(self.merge_dir):
+                os.makedirs(self.merge_dir)
+            self.journal = RestoreJournal(os.path.join(self.merge_dir, '%s.journal' % keyspace))
+            source = self.local_source or self.snapshot.name
+            if not self.journal.open(source, keyspace, resume=self.resume):
+                self._delete_old_dir(keyspace)
+
+        self.keyspace = keyspace
+        self.tables = set()
+        self.table_dirs = {}
+        self.planned_files = set()
+        self.transferred_tables = set()
+        self.found_files = self.found_size = 0
+        self.planned = False
+        self.target_hosts = target_hosts
+        self.pending = {}
+        self.loads = {}
+        self.loader_pool = Pool(self.loader_concurrency)
 
-        logging.info("Found %(files_count)d files, with total size of %(size)s." % dict(
-            files_count=len(keys),
-            size=self._human_size(total_size)))
-
-        self._download_keys(keys, total_size)
+        try:
+            # files are downloaded while they are still being listed,
+            # tables are loaded while the others are still downloading
+            self._download_keys(self._plan(keys))
 
-        logging.info("Finished downloading...")
+            logging.info("Finished downloading...")
 
-        self._run_sstableloader(keyspace, tables, target_hosts)
+            self._wait_for_loads()
+        finally:
+            self.loader_pool.terminate()
+            self.loader_pool.join()
+            if self.journal is not None:
+                self.journal.close()
 
-    def _delete_old_dir_and_create_new(self, keyspace, tables):
+    def _delete_old_dir(self, keyspace):
 
         keyspace_path = os.path.join(self.merge_dir, keyspace)
 
@@ -230,44 +968,65 @@ class RestoreWorker(object):
             logging.warning("Deleteing directory (%s)..." % keyspace_path)
             shutil.rmtree(keyspace_path)
 
-        for table in tables:
-            path = os.path.join(keyspace_path, table)
-            if not os.path.exists(path):
-                os.makedirs(path)
-
-    def _download_keys(self, keys, total_size, pool_size=5):
+    def _download_keys(self, keys):
         logging.info("Starting to download...")
 
         progress_string = ""
         read_bytes = 0
 
-        thread_pool = Pool(pool_size)
+        if self.max_download_concurrency:
+            self.concurrency = AdaptiveConcurrency(self.download_concurrency, self.max_download_concurrency)
+            pool_size = self.max_download_concurrency
+        else:
+            self.concurrency = ConcurrencyLimit(self.download_concurrency)
+            pool_size = self.download_concurrency
 
-        if self.local_source:
-            meth = self._copy_key
+        if self.decompress_processes and not self.local_source:
+            # forked before the download threads start
+            self.decompress_pool = DecompressPool(self.decompress_processes)
 
-        else:
-            meth = self._download_key
-
-        for size in thread_pool.imap(meth, keys):
-            logging.info("finished set")
-            old_width = len(progress_string)
-            read_bytes += size
-            progress_string = "%s / %s (%.2f%%)" % (self._human_size(read_bytes),
-                                                    self._human_size(total_size),
-                                                    (read_bytes / float(total_size)) * 100.0)
-            width = len(progress_string)
-            padding = ""
-            if width < old_width:
-                padding = " " * (width - old_width)
-            progress_string = "%s%s\r" % (progress_string, padding)
-
-            sys.stderr.write(progress_string)
+        thread_pool = Pool(pool_size)
+
+        try:
+            for size in thread_pool.imap_unordered(self._transfer_key, keys):
+                logging.info("finished set")
+                old_width = len(progress_string)
+                read_bytes += size
+                if self.planned:
+                    progress_string = "%s / %s (%.2f%%)" % (self._human_size(read_bytes),
+                                                            self._human_size(self.found_size),
+                                                            (read_bytes / float(self.found_size)) * 100.0)
+                else:
+                    progress_string = "%s / %s found so far (listing...)" % (self._human_size(read_bytes),
+                                                                             self._human_size(self.found_size))
+                width = len(progress_string)
+                padding = ""
+                if width < old_width:
+                    padding = " " * (old_width - width)
+                progress_string = "%s%s\r" % (progress_string, padding)
+
+                sys.stderr.write(progress_string)
+
+            thread_pool.close()
+            thread_pool.join()
+            if self.decompress_pool is not None:
+                self.decompress_pool.close()
+        finally:
+            if self.engine is not None:
+                self.engine.terminate()
+            if self.decompress_pool is not None:
+                self.decompress_pool.terminate()
+                self.decompress_pool = None
 
     def dst_from_key(self, path):
         r = self.keyspace_table_matcher.search(path)
 
-        merge_name = '%s_%s' % (r.group(1), path.split(self.path_separator)[-1])
+        if self.data_path:
+            dst = os.path.join(self.table_dir(r.group(3)), strip_codec_suffix(path.split(self.path_separator)[-1]))
+            logging.info("destination: %(key)s to %(filename)s" % dict(key=path, filename=dst))
+            return dst
+
+        merge_name = '%s_%s' % (r.group(1), strip_codec_suffix(path.split(self.path_separator)[-1]))
 
         dst = os.path.join(self.merge_dir, r.group(2), r.group(3), merge_name)
 
@@ -279,15 +1038,120 @@ class RestoreWorker(object):
 
         return dst
 
-    def _copy_key(self, key):
-        dst = self.dst_from_key(path=key)
-        shutil.copy2(src=key, dst=dst)
-
-        return os.path.getsize(key)
-
-    def _download_key(self, key):
-        dst = self.dst_from_key(path=key.name)
-        download_snappy_key(key, dst)
+    def table_dir(self, table):
+        """
+        returns the directory of a table in the local data path, table is the
+        directory name on the source node: the id suffixing it (cassandra 2.1+)
+        differs between clusters, the most recent directory of the table is used
+        """
+        with self._tables_lock:
+            if table not in self.table_dirs:
+                table_name = table.split('-', 1)[0]
+                keyspace_path = os.path.join(self.data_path, self.keyspace)
+                candidates = glob.glob(os.path.join(keyspace_path, table_name))
+                candidates += glob.glob(os.path.join(keyspace_path, table_name + '-*'))
+                if not candidates:
+                    raise IOError("table %s.%s does not exist in %s, create its schema first" % (
+                        self.keyspace, table_name, self.data_path))
+                self.table_dirs[table] = max(candidates, key=os.path.getmtime)
+            return self.table_dirs[table]
+
+    def _source_size(self, source):
+        if self.local_source:
+            return os.path.getsize(source)
+        return source.size
+
+    def _transfer_key(self, item):
+        name, source = item
+        table = self.keyspace_table_matcher.search(name).group(3)
+        if self.journal is not None and self.journal.is_complete(self.dst_from_key(name)):
+            logging.info("%s already restored" % name)
+            self._file_downloaded(table, transferred=False)
+            return self._source_size(source)
+
+        self.concurrency.acquire()
+        start = time.time()
+        size = 0
+        try:
+            if self.local_source:
+                size = self._copy_key(item)
+            else:
+                size = self._download_key(item)
+        finally:
+            self.concurrency.release(size, time.time() - start)
+        if self.journal is not None:
+            self._record_file(name, source)
+        self._file_downloaded(table)
+        return size
+
+    def _record_file(self, name, source):
+        dst = self.dst_from_key(name)
+        checksum = file_checksum(dst)
+        expected = getattr(source, 'checksum', None)
+        if expected and expected != checksum:
+            raise IOError("%s restored from %s has checksum %s, expected %s" % (dst, source.name, checksum, expected))
+        self.journal.record_file(dst, os.path.getsize(dst), checksum)
+
+    def _file_downloaded(self, table, transferred=True):
+        with self._tables_lock:
+            self.pending[table] -= 1
+            if transferred:
+                self.transferred_tables.add(table)
+            self._load_downloaded_tables()
+
+    def _load_downloaded_tables(self):
+        """
+        starts loading the tables whose files are all downloaded,
+        which is only known once every file to restore has been found
+        """
+        if not self.planned:
+            return
+        for table, pending in self.pending.items():
+            if pending == 0 and table not in self.loads:
+                if (self.journal is not None and table in self.journal.tables and
+                        table not in self.transferred_tables):
+                    logging.info("%s already loaded" % table)
+                    continue
+                logging.info("All files of %s downloaded, loading it" % table)
+                self.loads[table] = self.loader_pool.apply_async(
+                    self._run_loader, (self.keyspace, table, self.target_hosts))
+
+    def _wait_for_loads(self):
+        failed = []
+        for table in sorted(self.loads):
+            returncode, elapsed, attempts = self.loads[table].get()
+            logging.info("loading %(table)s exited with %(returncode)d after %(elapsed).1fs "
+                         "(%(attempts)d attempts)" % dict(table=table, returncode=returncode,
+                                                          elapsed=elapsed, attempts=attempts))
+            if returncode != 0:
+                failed.append(table)
+        self.loader_pool.close()
+        self.loader_pool.join()
+        if failed:
+            raise SSTableLoaderError("loading failed for tables: %s" % ', '.join(failed))
+
+    def _copy_key(self, item):
+        name, path = item
+        dst = self.dst_from_key(path=name)
+        how = link_or_copy(path, dst)
+        logging.info("%(how)s %(path)s to %(filename)s" % dict(how=how, path=path, filename=dst))
+
+        return os.path.getsize(path)
+
+    def _download_key(self, item):
+        name, key = item
+        dst = self.dst_from_key(path=name)
+        if not self.data_path:
+            return download_key(self.engine, key, dst, self.part_concurrency, self.concurrency,
+                                self.decompress_pool)
+
+        if os.path.exists(dst):
+            raise IOError("%s already exists, restore into empty tables" % dst)
+        # never leave a partial sstable component in the data directory
+        size = download_key(self.engine, key, dst + '.tmp', self.part_concurrency, self.concurrency,
+                            self.decompress_pool)
+        os.rename(dst + '.tmp', dst)
+        return size
 
     @staticmethod
     def _human_size(size):
@@ -297,19 +1161,35 @@ class RestoreWorker(object):
             size /= 1024.0
         return "%3.1f%s" % (size, 'TB')
 
-    def _run_sstableloader(self, keyspace, tables, target_hosts):
-        # TODO: get path to sstableloader
-        hosts = ','.join(target_hosts)
-        for table in tables:
+    def _run_loader(self, keyspace, table, target_hosts):
+        """
+        loads a table with sstableloader (nodetool refresh when restoring
+        directly into the data path), returns the exit code of the last run,
+        the time spent loading the table and the number of runs
+        """
+        if self.data_path:
+            command = [self.nodetool_path, 'refresh', keyspace, table.split('-', 1)[0]]
+        else:
+            # TODO: get path to sstableloader
+            hosts = ','.join(target_hosts)
             path = os.path.join(self.merge_dir, keyspace, table)
-            command = 'sstableloader --nodes %(hosts)s -v %(path)s' % dict(hosts=hosts, path=path)
-            logging.info("invoking: -->\n\n%s", command)
-
+            command = ['sstableloader', '--nodes', hosts, '-v', path]
+        start = time.time()
+        attempts = 0
+        while True:
+            attempts += 1
+            logging.info("invoking: -->\n\n%s", ' '.join(command))
             try:
-                os.system(command)
-            except:
-                logging.exception("Failed to run command {0}".format(command))
-                raise
+                returncode = subprocess.call(command)
+            except OSError:
+                logging.exception("Failed to run command {0}".format(' '.join(command)))
+                returncode = -1
+            if returncode == 0 and self.journal is not None:
+                self.journal.record_table(table)
+            if returncode == 0 or attempts > self.loader_retries:
+                return returncode, time.time() - start, attempts
+            logging.warning("loading %s exited with %d, retrying" % (table, returncode))
+            time.sleep(LOADER_RETRY_DELAY)
 
 
 class BackupWorker(object):
@@ -334,7 +1214,10 @@ class BackupWorker(object):
     def __init__(self, aws_secret_access_key,
                  aws_access_key_id, s3_bucket_region, s3_ssenc, s3_connection_host, cassandra_data_path,
                  nodetool_path, cassandra_bin_dir, backup_schema,
-                 connection_pool_size=12, use_sudo=True, agent_path=None, agent_virtualenv=None):
+                 connection_pool_size=12, use_sudo=True, agent_path=None, agent_virtualenv=None, dedup=False,
+                 codec='snappy', codec_level=None, max_network_rate=None, max_disk_rate=None, throttle_hours=None,
+                 throttle_max_pending_compactions=None, throttle_max_read_latency=None,
+                 catalog_cache_dir=CATALOG_CACHE_DIR):
         self.aws_secret_access_key = aws_secret_access_key
         self.aws_access_key_id = aws_access_key_id
         self.s3_bucket_region = s3_bucket_region
@@ -345,6 +1228,15 @@ class BackupWorker(object):
         self.cassandra_cli_path = "%s/cassandra-cli" % cassandra_bin_dir
         self.backup_schema = backup_schema
         self.connection_pool_size = connection_pool_size
+        self.dedup = dedup
+        self.codec = codec
+        self.codec_level = codec_level
+        self.max_network_rate = max_network_rate
+        self.max_disk_rate = max_disk_rate
+        self.throttle_hours = throttle_hours
+        self.throttle_max_pending_compactions = throttle_max_pending_compactions
+        self.throttle_max_read_latency = throttle_max_read_latency
+        self.catalog_cache_dir = catalog_cache_dir
         self.agent_path = agent_path or 'cassandra-snapshotter-agent'
         if use_sudo:
             self.run_remotely = lambda cmd: env.run('sudo ' + cmd)
@@ -379,7 +1271,7 @@ class BackupWorker(object):
         with prefix(self.agent_prefix):
             self.run_remotely(cmd)
 
-        upload_command = "%(agent_path)s %(incremental_backups)s put --aws-access-key-id=%(key)s --aws-secret-access-key=%(secret)s --s3-bucket-name=%(bucket)s --s3-bucket-region=%(s3_bucket_region)s %(s3_ssenc)s --s3-base-path=%(s3prefix)s --manifest=%(manifest)s --concurrency=4"
+        upload_command = "%(agent_path)s %(incremental_backups)s put --aws-access-key-id=%(key)s --aws-secret-access-key=%(secret)s --s3-bucket-name=%(bucket)s --s3-bucket-region=%(s3_bucket_region)s %(s3_ssenc)s --s3-base-path=%(s3prefix)s --manifest=%(manifest)s --concurrency=4 --codec=%(codec)s %(codec_level)s %(dedup)s %(throttle)s"
         cmd = upload_command % dict(
             bucket=snapshot.s3_bucket,
             s3_bucket_region=self.s3_bucket_region,
@@ -389,11 +1281,31 @@ class BackupWorker(object):
             secret=self.aws_secret_access_key,
             manifest=manifest_path,
             agent_path=self.agent_path,
-            incremental_backups=incremental_backups and '--incremental_backups' or ''
+            incremental_backups=incremental_backups and '--incremental_backups' or '',
+            dedup=self.dedup and '--dedup-base-path=%s' % snapshot.objects_path or '',
+            codec=self.codec,
+            codec_level=self.codec_level and '--codec-level=%d' % self.codec_level or '',
+            throttle=self.get_throttle_arguments()
         )
         with prefix(self.agent_prefix):
             self.run_remotely(cmd)
 
+    def get_throttle_arguments(self):
+        arguments = []
+        if self.max_network_rate:
+            arguments.append('--max-network-rate=%s' % self.max_network_rate)
+        if self.max_disk_rate:
+            arguments.append('--max-disk-rate=%s' % self.max_disk_rate)
+        if arguments and self.throttle_hours:
+            arguments.append('--throttle-hours=%s' % self.throttle_hours)
+        if arguments and self.throttle_max_pending_compactions is not None:
+            arguments.append('--throttle-max-pending-compactions=%d' % self.throttle_max_pending_compactions)
+        if arguments and self.throttle_max_read_latency is not None:
+            arguments.append('--throttle-max-read-latency=%s' % self.throttle_max_read_latency)
+        if arguments:
+            arguments.append('--nodetool-path=%s' % self.nodetool_path)
+        return ' '.join(arguments)
+
     def snapshot(self, snapshot, keep_new_snapshot=False, delete_old_snapshots=False, delete_backups=False):
         """
         Perform a snapshot
@@ -434,6 +1346,7 @@ class BackupWorker(object):
         self.start_cluster_backup(snapshot, incremental_backups=True)
         self.upload_cluster_backups(snapshot, incremental_backups=True)
         self.write_ring_description(snapshot)
+        self.write_catalog_index(snapshot)
         if self.backup_schema:
             self.write_schema(snapshot)
 
@@ -454,16 +1367,36 @@ class BackupWorker(object):
         return schema
 
     def write_on_s3(self, bucket_name, path, content):
-        conn = S3Connection(self.aws_access_key_id, self.aws_secret_access_key, host=self.s3_connection_host)
-        bucket = conn.get_bucket(bucket_name, validate=False)
+        bucket = self.get_bucket(bucket_name)
         key = bucket.new_key(path)
         key.set_contents_from_string(content)
 
+    def get_node_addresses(self):
+        with hide('output'):
+            return self.run_remotely('hostname -I').split()
+
     def write_ring_description(self, snapshot):
         logging.info('Writing ring description')
         content = self.get_ring_description()
         ring_path = '/'.join([snapshot.base_path, 'ring'])
         self.write_on_s3(snapshot.s3_bucket, ring_path, content)
+        self.write_ring_addresses(snapshot, parse_ring(content))
+
+    def write_ring_addresses(self, snapshot, ring):
+        """
+        saves the address every host has in the ring, restores into
+        other clusters can't resolve the names of the hosts
+        """
+        with settings(parallel=True, pool_size=self.connection_pool_size):
+            addresses = execute(self.get_node_addresses)
+        ring_addresses = dict((host, ring_address(node_addresses, ring))
+                              for host, node_addresses in addresses.items())
+        ring_addresses_path = '/'.join([snapshot.base_path, RING_ADDRESSES_NAME])
+        self.write_on_s3(snapshot.s3_bucket, ring_addresses_path, json.dumps(ring_addresses))
+
+    def get_bucket(self, bucket_name):
+        conn = S3Connection(self.aws_access_key_id, self.aws_secret_access_key, host=self.s3_connection_host)
+        return conn.get_bucket(bucket_name, validate=False)
 
     def write_schema(self, snapshot):
         if snapshot.keyspaces:
@@ -482,6 +1415,55 @@ class BackupWorker(object):
         content = snapshot.dump_manifest_file()
         manifest_path = '/'.join([snapshot.base_path, 'manifest.json'])
         self.write_on_s3(snapshot.s3_bucket, manifest_path, content)
+        self.write_catalog_index(snapshot)
+
+    def count_snapshot_usage(self, snapshot, indexed=None):
+        """
+        counts the files and bytes stored by a snapshot from the file indexes
+        of its nodes; the counts of indexed (the catalog index entry of the
+        snapshot) are kept and only the file indexes written since are listed
+        (S3 lists the keys after the last counted one) and read
+
+        the usage of snapshots without file indexes stays unknown,
+        counting it would list every file of the snapshot
+        """
+        if indexed is not None and indexed.counted_indexes is not None:
+            files, size, counted = indexed.files, indexed.size, dict(indexed.counted_indexes)
+        elif snapshot.file_indexes:
+            files, size, counted = 0, 0, {}
+        else:
+            snapshot.files = snapshot.size = snapshot.counted_indexes = None
+            return
+        bucket = self.get_bucket(snapshot.s3_bucket)
+        for host in snapshot.hosts:
+            index_prefix = '/'.join([snapshot.base_path, host, FILE_INDEX_DIR, ''])
+            for key in bucket.list(index_prefix, marker=counted.get(host, '')):
+                file_index = json.loads(key.get_contents_as_string())
+                files += len(file_index['files'])
+                size += sum(entry['stored_size'] for entry in file_index['files'])
+                counted[host] = key.name
+        snapshot.files, snapshot.size, snapshot.counted_indexes = files, size, counted
+
+    def write_catalog_index(self, snapshot):
+        """
+        rewrites the catalog index of the snapshot's base path
+
+        the snapshots are listed from S3 (so that snapshots expired by
+        lifecycle rules drop out of the index) and the summaries of the
+        snapshots already in the index are kept, only the manifests of the
+        snapshots missing from it are read (see SnapshotCollection._check_index)
+        """
+        logging.info('Writing catalog index')
+        collection = SnapshotCollection(self.aws_access_key_id, self.aws_secret_access_key,
+                                        snapshot._base_path, snapshot.s3_bucket,
+                                        cache_dir=self.catalog_cache_dir)
+        indexed = dict((s.name, s) for s in collection.read_index() or [])
+        self.count_snapshot_usage(snapshot, indexed.get(snapshot.name))
+        indexed[snapshot.name] = snapshot
+        snapshots = collection._check_index(sorted(indexed.values(), reverse=True))
+        lines = [listed.dump_index_entry() for listed in snapshots]
+        index_path = '/'.join([snapshot._base_path, CATALOG_INDEX_NAME])
+        self.write_on_s3(snapshot.s3_bucket, index_path, '\n'.join(lines))
 
     def start_cluster_backup(self, snapshot, incremental_backups=False):
         logging.info('Creating snapshots')
@@ -560,53 +1542,370 @@ class BackupWorker(object):
         self.run_remotely(cmd)
 
 
+class DirectRestoreWorker(object):
+    """
+    Restores a snapshot into a cluster owning the same token ranges as the
+    snapshotted one, without a merge directory nor sstableloader
+
+    The ring saved next to the snapshot (see BackupWorker.write_ring_description)
+    is compared with the ring of the target cluster, every target node then
+    downloads the files of the source node that owned its tokens straight
+    into its table directories and loads them with nodetool refresh
+    (agent fetch), all nodes in parallel.
+
+    Hosts are matched to the addresses of the rings by the addresses of
+    their interfaces: source hosts by the ones saved with the snapshot
+    (see BackupWorker.write_ring_addresses), target hosts by asking them.
+    Source hosts of snapshots saved without them are resolved by name.
+    """
+
+    def __init__(self, aws_secret_access_key, aws_access_key_id, s3_bucket_region, cassandra_data_path,
+                 nodetool_path, cassandra_bin_dir, connection_pool_size=12, use_sudo=True, agent_path=None,
+                 agent_virtualenv=None):
+        self.aws_secret_access_key = aws_secret_access_key
+        self.aws_access_key_id = aws_access_key_id
+        self.s3_bucket_region = s3_bucket_region
+        self.cassandra_data_path = cassandra_data_path
+        self.nodetool_path = nodetool_path or os.path.join(cassandra_bin_dir, "nodetool")
+        self.connection_pool_size = connection_pool_size
+        self.agent_path = agent_path or 'cassandra-snapshotter-agent'
+        if use_sudo:
+            self.run_remotely = lambda cmd: env.run('sudo ' + cmd)
+        else:
+            self.run_remotely = env.run
+        if agent_virtualenv:
+            self.agent_prefix = 'source %s/bin/activate' % agent_virtualenv
+        else:
+            self.agent_prefix = 'true'
+
+    @staticmethod
+    def resolve(host):
+        return socket.gethostbyname(host.split('@')[-1].split(':')[0])
+
+    def get_ring_description(self):
+        with settings(host_string=env.hosts[0]):
+            with hide('output'):
+                ring_description = self.run_remotely(self.nodetool_path + ' ring')
+        return ring_description
+
+    def get_node_addresses(self):
+        with hide('output'):
+            return self.run_remotely('hostname -I').split()
+
+    def get_snapshot_ring_description(self, snapshot):
+        conn = S3Connection(self.aws_access_key_id, self.aws_secret_access_key)
+        bucket = conn.get_bucket(snapshot.s3_bucket, validate=False)
+        key = bucket.get_key('/'.join([snapshot.base_path, 'ring']))
+        if key is None:
+            raise RingMismatchError("no ring description saved with snapshot %s" % snapshot.name)
+        return key.get_contents_as_string()
+
+    def get_snapshot_ring_addresses(self, snapshot):
+        conn = S3Connection(self.aws_access_key_id, self.aws_secret_access_key)
+        bucket = conn.get_bucket(snapshot.s3_bucket, validate=False)
+        key = bucket.get_key('/'.join([snapshot.base_path, RING_ADDRESSES_NAME]))
+        if key is None:
+            return {}
+        return json.loads(key.get_contents_as_string())
+
+    def plan(self, snapshot, hosts, target_hosts):
+        """
+        returns the source host every target host restores the files of
+        """
+        target_ring = parse_ring(self.get_ring_description())
+        matches = match_rings(parse_ring(self.get_snapshot_ring_description(snapshot)), target_ring)
+        if matches is None:
+            raise RingMismatchError("the target cluster does not own the token ranges of snapshot %s, "
+                                    "restore it with sstableloader" % snapshot.name)
+        with settings(parallel=True, pool_size=self.connection_pool_size):
+            target_addresses = execute(self.get_node_addresses, hosts=target_hosts)
+        targets = {}
+        for target_host in target_hosts:
+            address = ring_address(target_addresses[target_host], target_ring)
+            if address is None:
+                raise RingMismatchError("none of the addresses of %s (%s) is in the target ring" % (
+                    target_host, ', '.join(target_addresses[target_host])))
+            targets[address] = target_host
+        ring_addresses = self.get_snapshot_ring_addresses(snapshot)
+        plan = {}
+        for host in hosts:
+            address = ring_addresses.get(host) or self.resolve(host)
+            if address not in matches:
+                raise RingMismatchError("%s (%s) is not in the ring of snapshot %s" % (host, address, snapshot.name))
+            if matches[address] not in targets:
+                raise RingMismatchError("%s owns the tokens of %s but is not a target host" % (matches[address], host))
+            plan[targets[matches[address]]] = host
+        return plan
+
+    def restore(self, snapshot, keyspace, table, hosts, target_hosts, as_of=None):
+        plan = self.plan(snapshot, hosts, target_hosts)
+        for target_host, host in sorted(plan.items()):
+            logging.info("%s restores the files of %s" % (target_host, host))
+        with settings(parallel=True, pool_size=self.connection_pool_size):
+            execute(self.node_fetch, snapshot, keyspace, table, plan, as_of, hosts=sorted(plan))
+
+    def node_fetch(self, snapshot, keyspace, table, plan, as_of=None):
+        """
+        restores the files of a source host on a cassandra node
+        """
+        fetch_command = "%(agent_path)s fetch --aws-access-key-id=%(key)s --aws-secret-access-key=%(secret)s --s3-bucket-name=%(bucket)s --s3-bucket-region=%(s3_bucket_region)s --s3-base-path=%(s3_base_path)s --snapshot-name=%(snapshot_name)s --source-host=%(source_host)s --keyspace=%(keyspace)s %(table)s --data-path=%(data_path)s --nodetool-path=%(nodetool)s %(as_of)s"
+        cmd = fetch_command % dict(
+            agent_path=self.agent_path,
+            key=self.aws_access_key_id,
+            secret=self.aws_secret_access_key,
+            bucket=snapshot.s3_bucket,
+            s3_bucket_region=self.s3_bucket_region,
+            s3_base_path=snapshot._base_path,
+            snapshot_name=snapshot.name,
+            source_host=plan[env.host_string],
+            keyspace=keyspace,
+            table=table and '--table=%s' % table or '',
+            data_path=self.cassandra_data_path,
+            nodetool=self.nodetool_path,
+            as_of=as_of and '--as-of=%s' % as_of.strftime(Snapshot.SNAPSHOT_TIMESTAMP_FORMAT) or ''
+        )
+        with prefix(self.agent_prefix):
+            self.run_remotely(cmd)
+
+
 class SnapshotCollection(object):
+    """
+    The snapshots stored under a base path, most recent first
+
+    Manifests are fetched concurrently and snapshots are yielded as soon as
+    they (and all the more recent ones) are loaded, so that lookups of recent
+    snapshots stop without loading the whole history.
+
+    Manifests are cached on disk (under cache_dir) together with their etag;
+    only manifests of new snapshots are downloaded, cached ones are revalidated
+    with a conditional GET once they are older than CATALOG_REVALIDATE_AFTER.
+
+    When the base path has a catalog index the snapshots are read from it
+    with a single (conditional) GET, manifests are only listed and read when
+    the index is missing or can't be parsed. The index is checked against a
+    single delimited LIST of the snapshots, see _check_index.
 
-    def __init__(self, aws_access_key_id, aws_secret_access_key, base_path, s3_bucket):
+    Requests go through a TransferEngine running fetch_concurrency at a time.
+    """
+
+    def __init__(self, aws_access_key_id, aws_secret_access_key, base_path, s3_bucket,
+                 fetch_concurrency=MANIFEST_FETCH_CONCURRENCY, cache_dir=CATALOG_CACHE_DIR, use_index=True):
         self.s3_bucket = s3_bucket
         self.base_path = base_path
         self.snapshots = None
         self.aws_access_key_id = aws_access_key_id
         self.aws_secret_access_key = aws_secret_access_key
+        self.fetch_concurrency = fetch_concurrency
+        self.cache_dir = cache_dir
+        self.use_index = use_index
+        self.engine = TransferEngine(s3_bucket, aws_access_key_id, aws_secret_access_key,
+                                     max_in_flight=fetch_concurrency)
+        self._catalog = None
 
-    def _read_s3(self):
-        if self.snapshots:
-            return
+    @property
+    def bucket(self):
+        return self.engine.bucket
 
-        conn = S3Connection(self.aws_access_key_id, self.aws_secret_access_key)
-        bucket = conn.get_bucket(self.s3_bucket, validate=False)
-        self.snapshots = []
+    def _list_snapshot_paths(self):
         s3prefix = self.base_path
         if not self.base_path.endswith('/'):
             s3prefix = '%s/' % self.base_path
-        snap_paths = [snap.name for snap in bucket.list(
+        snap_paths = [snap.name for snap in self.bucket.list(
             prefix=s3prefix, delimiter='/')]
         # Remove the root dir from the list since it won't have a manifest file.
         snap_paths = [x for x in snap_paths if x != s3prefix]
-        for snap_path in snap_paths:
-            mkey = Key(bucket)
-            manifest_path = '/'.join([snap_path, 'manifest.json'])
-            mkey.key = manifest_path
+        # Skip the object store and other metadata living next to the snapshots.
+        snap_paths = [x for x in snap_paths if not x[len(s3prefix):].startswith('_')]
+        # Snapshot names are timestamps, most recent first.
+        return sorted(snap_paths, reverse=True)
+
+    @property
+    def catalog_path(self):
+        return os.path.join(self.cache_dir, self.s3_bucket, self.base_path.strip('/'), 'catalog.json')
+
+    @property
+    def index_cache_path(self):
+        return os.path.join(self.cache_dir, self.s3_bucket, self.base_path.strip('/'), CATALOG_INDEX_NAME)
+
+    def _fetch_index(self):
+        """
+        returns the content of the catalog index, the copy in
+        the cache when its etag did not change
+        """
+        cached = None
+        if self.cache_dir and os.path.exists(self.index_cache_path):
             try:
-                manifest_data = mkey.get_contents_as_string()
-            except S3ResponseError as e:  # manifest.json not found.
-                logging.warn('Response: %r manifest_path: %r' % (e.message, manifest_path))
-                continue
+                with open(self.index_cache_path) as cache_file:
+                    cached = json.load(cache_file)
+            except Exception as e:  # corrupted cache, start over
+                logging.warn('Ignoring catalog index cache %s: %r' % (self.index_cache_path, e))
+
+        index_key = Key(self.bucket)
+        index_key.key = '/'.join([self.base_path.rstrip('/'), CATALOG_INDEX_NAME])
+        headers = cached and {'If-None-Match': cached['etag']} or None
+        try:
+            data = self.engine.retry(index_key.get_contents_as_string, headers)
+        except S3ResponseError as e:
+            if cached and e.status == 304:  # not modified
+                return cached['data']
+            logging.info('No catalog index at %s: %r' % (index_key.key, e.message))
+            return None
+
+        if self.cache_dir:
             try:
-                self.snapshots.append(
-                    Snapshot.load_manifest_file(manifest_data, self.s3_bucket))
-            except Exception as e:  # Invalid json format.
-                logging.error('Parsing manifest.json failed. %r', e.message)
-                continue
-        self.snapshots = sorted(self.snapshots, reverse=True)
+                cache_dir = os.path.dirname(self.index_cache_path)
+                if not os.path.exists(cache_dir):
+                    os.makedirs(cache_dir)
+                with open(self.index_cache_path, 'w') as cache_file:
+                    json.dump({'etag': index_key.etag, 'data': data}, cache_file)
+            except (IOError, OSError) as e:
+                logging.warn('Could not write catalog index cache %s: %r' % (self.index_cache_path, e))
+        return data
+
+    def read_index(self):
+        """
+        returns the snapshots in the catalog index, most recent first,
+        or None when there is no (valid) index
+        """
+        data = self._fetch_index()
+        if data is None:
+            return None
+        try:
+            snapshots = [Snapshot.load_index_entry(line, self.s3_bucket)
+                         for line in data.splitlines() if line.strip()]
+        except Exception as e:  # Invalid json format.
+            logging.error('Parsing catalog index failed. %r', e)
+            return None
+        return sorted(snapshots, reverse=True)
+
+    def _load_catalog(self):
+        self._catalog = {}
+        if not self.cache_dir or not os.path.exists(self.catalog_path):
+            return
+        try:
+            with open(self.catalog_path) as catalog_file:
+                self._catalog = json.load(catalog_file)
+        except Exception as e:  # corrupted cache, start over
+            logging.warn('Ignoring catalog cache %s: %r' % (self.catalog_path, e))
+
+    def _save_catalog(self, snap_paths):
+        if not self.cache_dir:
+            return
+        catalog = dict((path, self._catalog[path]) for path in snap_paths if path in self._catalog)
+        catalog_dir = os.path.dirname(self.catalog_path)
+        try:
+            if not os.path.exists(catalog_dir):
+                os.makedirs(catalog_dir)
+            tmp_path = '%s.%d' % (self.catalog_path, os.getpid())
+            with open(tmp_path, 'w') as catalog_file:
+                json.dump(catalog, catalog_file)
+            os.rename(tmp_path, self.catalog_path)
+        except (IOError, OSError) as e:
+            logging.warn('Could not write catalog cache %s: %r' % (self.catalog_path, e))
+
+    def _read_manifest(self, snap_path):
+        cached = self._catalog.get(snap_path)
+        if cached and time.time() - cached['checked'] < CATALOG_REVALIDATE_AFTER:
+            manifest_data = cached['manifest']
+        else:
+            manifest_data = self._fetch_manifest(snap_path, cached)
+            if manifest_data is None:
+                return None
+        try:
+            return Snapshot.load_manifest_file(manifest_data, self.s3_bucket)
+        except Exception as e:  # Invalid json format.
+            logging.error('Parsing manifest.json failed. %r', e.message)
+            return None
+
+    def _fetch_manifest(self, snap_path, cached=None):
+        mkey = Key(self.bucket)
+        manifest_path = '/'.join([snap_path.rstrip('/'), 'manifest.json'])
+        mkey.key = manifest_path
+        headers = cached and {'If-None-Match': cached['etag']} or None
+        try:
+            manifest_data = self.engine.retry(mkey.get_contents_as_string, headers)
+        except S3ResponseError as e:
+            if cached and e.status == 304:  # not modified
+                cached['checked'] = time.time()
+                return cached['manifest']
+            # manifest.json not found.
+            logging.warn('Response: %r manifest_path: %r' % (e.message, manifest_path))
+            self._catalog.pop(snap_path, None)
+            return None
+        self._catalog[snap_path] = {
+            'etag': mkey.etag,
+            'manifest': manifest_data,
+            'checked': time.time()
+        }
+        return manifest_data
+
+    def _iter_s3(self):
+        if self.use_index:
+            snapshots = self.read_index()
+            if snapshots is not None:
+                self.snapshots = self._check_index(snapshots)
+                for snapshot in self.snapshots:
+                    yield snapshot
+                return
+        for snapshot in self.iter_manifests():
+            yield snapshot
+
+    def _check_index(self, snapshots):
+        """
+        returns the snapshots of the catalog index merged with the snapshots
+        listed on S3: snapshots expired since are dropped and the manifests of
+        the snapshots missing from the index (its update failed, or they were
+        written by an older version) are read
+        """
+        snap_paths = self._list_snapshot_paths()
+        indexed = dict((snapshot.name, snapshot) for snapshot in snapshots)
+        names = dict((snap_path, snap_path.rstrip('/').split('/')[-1]) for snap_path in snap_paths)
+        missing = [snap_path for snap_path in snap_paths if names[snap_path] not in indexed]
+        if not missing and len(snap_paths) == len(indexed):
+            return snapshots
+        logging.warn('Catalog index is stale, reading the manifests of %d snapshots missing from it' % len(missing))
+        if self._catalog is None:
+            self._load_catalog()
+        try:
+            read = [snapshot for snapshot in self.engine.imap(self._read_manifest, missing) if snapshot is not None]
+        finally:
+            self.engine.close()
+            self._save_catalog(snap_paths)
+        listed = [indexed[names[snap_path]] for snap_path in snap_paths if names[snap_path] in indexed]
+        return sorted(listed + read, reverse=True)
+
+    def iter_manifests(self):
+        """
+        yields the snapshots reading their manifests, most recent first
+        """
+        if self._catalog is None:
+            self._load_catalog()
+        snapshots = []
+        snap_paths = self._list_snapshot_paths()
+        try:
+            for snapshot in self.engine.imap(self._read_manifest, snap_paths):
+                if snapshot is None:
+                    continue
+                snapshots.append(snapshot)
+                yield snapshot
+        finally:
+            # stops fetching manifests when the caller stops iterating
+            self.engine.terminate()
+            self._save_catalog(snap_paths)
+        self.snapshots = sorted(snapshots, reverse=True)
 
     def get_snapshot_by_name(self, name):
-        snapshots = filter(lambda s: s.name == name, self)
-        return snapshots and snapshots[0]
+        for snapshot in self:
+            if snapshot.name == name:
+                return snapshot
 
-    def get_latest(self):
-        self._read_s3()
-        return self.snapshots[0]
+    def get_latest(self, before=None):
+        """
+        returns the most recent snapshot, taken before the before datetime if given
+        """
+        for snapshot in self:
+            if before is None or snapshot.name <= before.strftime(Snapshot.SNAPSHOT_TIMESTAMP_FORMAT):
+                return snapshot
 
     def get_snapshot_for(self, hosts, keyspaces, table):
         """
@@ -622,8 +1921,9 @@ class SnapshotCollection(object):
             return snapshot
 
     def __iter__(self):
-        self._read_s3()
-        return iter(self.snapshots)
+        if self.snapshots is not None:
+            return iter(self.snapshots)
+        return self._iter_s3()
 
     # def _restore_from_s3(self, keyspace, table, hosts, target_hosts):
     #     # TODO:
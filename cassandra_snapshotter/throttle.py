@@ -0,0 +1,193 @@
+"""
+Rate limits shared by all the uploads of an agent put run
+
+Rates are enforced by token buckets kept in small files locked with flock,
+so that concurrent put runs of the same manifest draw from the same budget.
+"""
+import fcntl
+import logging
+import os
+import re
+import subprocess
+import threading
+import time
+
+# a bucket holds at most this many seconds worth of tokens
+BURST_SECONDS = 1.0
+# how often the node load is sampled with nodetool
+LOAD_CHECK_INTERVAL = 30
+# adaptive throttling never goes below this share of the configured rates
+MIN_LOAD_FACTOR = 0.1
+
+logger = logging.getLogger(__name__)
+
+
+class SharedState(object):
+    """
+    A few floats stored in a file, read and updated under an exclusive lock
+
+    flock does not exclude the threads sharing the file descriptor,
+    they take turns on a thread lock first
+    """
+
+    def __init__(self, path, defaults):
+        self.path = path
+        self.defaults = defaults
+        self._fd = None
+        self._lock = threading.Lock()
+
+    def update(self, function):
+        """
+        replaces the state with function(state), returns the new state
+        """
+        with self._lock:
+            if self._fd is None:
+                self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                os.lseek(self._fd, 0, os.SEEK_SET)
+                data = os.read(self._fd, 4096).split()
+                if len(data) == len(self.defaults):
+                    state = [float(value) for value in data]
+                else:
+                    state = list(self.defaults)
+                state = function(state)
+                os.lseek(self._fd, 0, os.SEEK_SET)
+                os.ftruncate(self._fd, 0)
+                os.write(self._fd, ' '.join(repr(value) for value in state))
+                return state
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+
+class TokenBucket(object):
+    """
+    Limits the rate (in bytes per second) of whoever consumes from it
+
+    Consumers reserve what they need and sleep until the bucket has refilled
+    enough, reservations can take the bucket below zero.
+    """
+
+    def __init__(self, path, rate):
+        self.rate = rate
+        self.state = SharedState(path, [rate * BURST_SECONDS, time.time()])
+
+    def consume(self, amount, factor=1.0):
+        rate = self.rate * factor
+
+        def reserve(state):
+            tokens, last = state
+            now = time.time()
+            tokens = min(rate * BURST_SECONDS, tokens + (now - last) * rate)
+            return [tokens - amount, now]
+
+        tokens, _ = self.state.update(reserve)
+        if tokens < 0:
+            time.sleep(-tokens / rate)
+
+
+class NodeLoad(object):
+    """
+    Scales the rates down while the cassandra node is busy
+
+    Every LOAD_CHECK_INTERVAL seconds one of the uploads samples the
+    pending compactions and the 99th percentile read latency of the node
+    with nodetool: the rates are halved while either is above its limit
+    and recover by a tenth of the configured rates per check otherwise.
+    """
+
+    def __init__(self, path, nodetool_path='nodetool', max_pending_compactions=None, max_read_latency=None):
+        self.nodetool_path = nodetool_path
+        self.max_pending_compactions = max_pending_compactions
+        self.max_read_latency = max_read_latency
+        self.state = SharedState(path, [1.0, 0.0])
+
+    def factor(self):
+        claimed = []
+
+        def claim(state):
+            factor, checked = state
+            now = time.time()
+            if now - checked >= LOAD_CHECK_INTERVAL:
+                claimed.append(now)
+                return [factor, now]
+            return state
+
+        factor, _ = self.state.update(claim)
+        if not claimed:
+            return factor
+
+        busy = self.is_busy()
+        if busy is None:
+            return factor
+
+        def adjust(state):
+            factor, checked = state
+            if busy:
+                factor = max(MIN_LOAD_FACTOR, factor / 2)
+            else:
+                factor = min(1.0, factor + 0.1)
+            return [factor, checked]
+
+        factor, _ = self.state.update(adjust)
+        logger.info("node %s, uploading at %d%% of the configured rates" % (
+            busy and 'busy' or 'idle', factor * 100))
+        return factor
+
+    def is_busy(self):
+        """
+        returns whether the node is over one of its limits, None when nodetool fails
+        """
+        try:
+            if self.max_pending_compactions is not None:
+                output = subprocess.check_output([self.nodetool_path, 'compactionstats'])
+                r = re.search(r'pending tasks:\s*(\d+)', output)
+                if r and int(r.group(1)) > self.max_pending_compactions:
+                    return True
+            if self.max_read_latency is not None:
+                output = subprocess.check_output([self.nodetool_path, 'proxyhistograms'])
+                r = re.search(r'^99%\s+([\d.]+)', output, re.MULTILINE)
+                # proxyhistograms reports microseconds
+                if r and float(r.group(1)) / 1000 > self.max_read_latency:
+                    return True
+        except (OSError, subprocess.CalledProcessError):
+            logger.warn("Failed to read the node load with nodetool")
+            return None
+        return False
+
+
+class Throttle(object):
+    """
+    Network and disk read rate limits of a put run
+
+    network_rate and disk_rate are bytes per second (None for no limit),
+    hours limits the throttling to a (start, end) range of local hours,
+    node_load (a NodeLoad) scales the rates down while the node is busy
+    """
+
+    def __init__(self, state_path, network_rate=None, disk_rate=None, hours=None, node_load=None):
+        self.network_bucket = network_rate and TokenBucket(state_path + '.network', network_rate)
+        self.disk_bucket = disk_rate and TokenBucket(state_path + '.disk', disk_rate)
+        self.hours = hours
+        self.node_load = node_load
+
+    def _active(self):
+        if self.hours is None:
+            return True
+        start, end = self.hours
+        hour = time.localtime().tm_hour
+        if start <= end:
+            return start <= hour < end
+        return hour >= start or hour < end
+
+    def _consume(self, bucket, amount):
+        if not bucket or not self._active():
+            return
+        factor = self.node_load and self.node_load.factor() or 1.0
+        bucket.consume(amount, factor)
+
+    def network(self, amount):
+        self._consume(self.network_bucket, amount)
+
+    def disk(self, amount):
+        self._consume(self.disk_bucket, amount)
@@ -1,28 +1,81 @@
-from functools import wraps
+"""
+Timeouts that work in any thread or process
+
+Stalled connections are caught by the socket timeout of boto's http
+connections (see set_socket_timeout), slow transfers by deadlines that
+the data being sent or received is checked against.
+"""
 import errno
 import os
-import signal
+import threading
+import time
+
+import boto
+
+DEFAULT_SOCKET_TIMEOUT = 60
 
 
 class TimeoutError(Exception):
     pass
 
 
-def timeout(seconds=10, error_message=os.strerror(errno.ETIME)):
+class CancelledError(TimeoutError):
+    pass
+
+
+def set_socket_timeout(seconds=DEFAULT_SOCKET_TIMEOUT):
+    """
+    sets the timeout of the sockets of the S3 connections created afterwards
+    """
+    if not boto.config.has_section('Boto'):
+        boto.config.add_section('Boto')
+    boto.config.set('Boto', 'http_socket_timeout', str(seconds))
+
+
+class Deadline(object):
+    """
+    The time by which an operation has to complete
+
+    Operations check the deadline as they make progress, a deadline can
+    also be cancelled (from any thread) to stop an operation early; the
+    deadlines of related operations can share their cancelled event.
+    """
+
+    def __init__(self, seconds, error_message=os.strerror(errno.ETIME), cancelled=None):
+        self.expires = time.time() + seconds
+        self.error_message = error_message
+        self._cancelled = threading.Event() if cancelled is None else cancelled
+
+    def remaining(self):
+        return max(0.0, self.expires - time.time())
+
+    def expired(self):
+        return self._cancelled.is_set() or time.time() >= self.expires
+
+    def cancel(self):
+        self._cancelled.set()
+
+    def check(self):
+        if self._cancelled.is_set():
+            raise CancelledError('cancelled')
+        if time.time() >= self.expires:
+            raise TimeoutError(self.error_message)
+
+
+class DeadlineFile(object):
+    """
+    Wraps a file object whose reads fail once the deadline has passed, boto
+    reads the body of a request from it while sending: a slow upload is
+    interrupted in the thread sending it
+    """
 
-    def decorator(func):
-        def _handle_timeout(signum, frame):
-            raise TimeoutError(error_message)
+    def __init__(self, file_object, deadline):
+        self.file_object = file_object
+        self.deadline = deadline
 
-        @wraps(func)
-        def wrapper(*args, **kwargs):
-            signal.signal(signal.SIGALRM, _handle_timeout)
-            signal.alarm(seconds)
-            try:
-                result = func(*args, **kwargs)
-            finally:
-                signal.alarm(0)
-            return result
-        return wrapper
+    def read(self, *args):
+        self.deadline.check()
+        return self.file_object.read(*args)
 
-    return decorator
+    def __getattr__(self, name):
+        return getattr(self.file_object, name)
@@ -0,0 +1,211 @@
+"""
+S3 requests shared by agent put, restores and catalog reads
+
+asyncio is not available on python 2: a TransferEngine runs requests on a
+pool of threads of a single process instead, every thread keeps its own
+S3 connection (boto keeps its http connections alive between requests)
+and at most max_in_flight requests run at the same time. Failed requests
+are retried according to one RetryPolicy.
+"""
+import httplib
+import logging
+import random
+import socket
+import threading
+import time
+from boto.exception import BotoServerError
+from boto.utils import parse_ts
+from boto.s3.connection import S3Connection
+from boto.s3.multipart import MultiPartUpload
+from compression import CodecError
+from datetime import datetime, timedelta
+from multiprocessing.dummy import Pool
+from timeout import CancelledError, TimeoutError
+
+MAX_ATTEMPTS = 3
+BASE_DELAY = 1.0
+MAX_DELAY = 30.0
+DEFAULT_MAX_IN_FLIGHT = 64
+# multipart uploads younger than this may belong to a running put
+SWEEP_OLDER_THAN = timedelta(hours=24)
+SWEEP_CONCURRENCY = 16
+# throttling and server side errors, everything else S3 answers with is final
+RETRYABLE_STATUSES = (408, 429, 500, 502, 503, 504)
+
+logger = logging.getLogger(__name__)
+
+
+class RetryPolicy(object):
+    """
+    Retries failed requests up to attempts times, waiting a random time
+    between 0 and base_delay * 2 ** attempt (capped at max_delay) before
+    every retry so that concurrent requests don't retry in lockstep
+    """
+
+    def __init__(self, attempts=MAX_ATTEMPTS, base_delay=BASE_DELAY, max_delay=MAX_DELAY):
+        self.attempts = attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def delay(self, attempt):
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    def is_retryable(self, error):
+        if isinstance(error, CancelledError):
+            return False
+        if isinstance(error, BotoServerError):
+            return error.status in RETRYABLE_STATUSES
+        return isinstance(error, (IOError, socket.error, httplib.HTTPException, TimeoutError, CodecError))
+
+    def call(self, function, *args):
+        """
+        returns function(*args), retrying it while it fails with retryable errors
+        """
+        attempt = 1
+        while True:
+            try:
+                return function(*args)
+            except Exception as e:
+                if attempt >= self.attempts or not self.is_retryable(e):
+                    raise
+                delay = self.delay(attempt)
+                logger.warn("%s failed (%r), retrying in %.1fs (attempt %d of %d)" % (
+                    getattr(function, '__name__', 'request'), e, delay, attempt + 1, self.attempts))
+                time.sleep(delay)
+                attempt += 1
+
+
+class TransferEngine(object):
+    """
+    Runs the requests to one bucket, at most max_in_flight at a time
+
+    Requests are submitted as functions run on the pool of the engine, they
+    must not wait for other requests of the same engine. Any thread (whether
+    it belongs to the pool or not) gets its own bucket from the bucket
+    property, connections are created on first use and reused afterwards.
+    """
+
+    def __init__(self, s3_bucket, aws_access_key_id=None, aws_secret_access_key=None, s3_connection_host=None,
+                 max_in_flight=DEFAULT_MAX_IN_FLIGHT, retry_policy=None):
+        self.s3_bucket = s3_bucket
+        self.aws_access_key_id = aws_access_key_id
+        self.aws_secret_access_key = aws_secret_access_key
+        self.s3_connection_host = s3_connection_host
+        self.max_in_flight = max_in_flight
+        self.retry_policy = RetryPolicy() if retry_policy is None else retry_policy
+        self._local = threading.local()
+        self._pool = None
+        self._lock = threading.Lock()
+
+    def connect(self):
+        options = {}
+        if self.s3_connection_host:
+            options['host'] = self.s3_connection_host
+        return S3Connection(aws_access_key_id=self.aws_access_key_id,
+                            aws_secret_access_key=self.aws_secret_access_key, **options)
+
+    @property
+    def bucket(self):
+        bucket = getattr(self._local, 'bucket', None)
+        if bucket is None:
+            bucket = self._local.bucket = self.connect().get_bucket(self.s3_bucket, validate=False)
+        return bucket
+
+    def multipart_upload(self, mp):
+        """
+        returns the multipart upload mp bound to the bucket of this thread
+        """
+        upload = MultiPartUpload(self.bucket)
+        upload.key_name = mp.key_name
+        upload.id = mp.id
+        return upload
+
+    @property
+    def pool(self):
+        with self._lock:
+            if self._pool is None:
+                self._pool = Pool(self.max_in_flight)
+            return self._pool
+
+    def retry(self, function, *args):
+        return self.retry_policy.call(function, *args)
+
+    def submit(self, function, *args):
+        """
+        runs function(*args) on the pool, returns its AsyncResult
+        """
+        return self.pool.apply_async(function, args)
+
+    def imap(self, function, items):
+        return self.pool.imap(function, items)
+
+    def imap_unordered(self, function, items):
+        return self.pool.imap_unordered(function, items)
+
+    def close(self):
+        """
+        waits for the submitted requests, the engine can still be used afterwards
+        """
+        with self._lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    def terminate(self):
+        """
+        drops the requests that did not start yet
+        """
+        with self._lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+
+
+def list_multipart_uploads(bucket, prefix):
+    """
+    yields the multipart uploads in progress of the keys starting with
+    prefix, S3 only lists those: the rest of the bucket is not scanned
+    """
+    key_marker = upload_id_marker = ''
+    while True:
+        results = bucket.get_all_multipart_uploads(prefix=prefix, key_marker=key_marker,
+                                                   upload_id_marker=upload_id_marker)
+        for mp in results:
+            yield mp
+        if not results.is_truncated:
+            return
+        key_marker = results.next_key_marker
+        upload_id_marker = results.next_upload_id_marker
+
+
+def sweep_multipart_uploads(engine, prefix, older_than=SWEEP_OLDER_THAN):
+    """
+    aborts the multipart uploads under prefix initiated more than older_than
+    (a timedelta) ago, left behind by failed or killed puts; uploads are
+    aborted in parallel on the engine
+
+    returns the number of aborted uploads and the size of their parts
+    """
+    def list_uploads():
+        return list(list_multipart_uploads(engine.bucket, prefix))
+
+    def abort(mp):
+        upload = engine.multipart_upload(mp)
+
+        def parts_size():
+            return sum(part.size for part in upload)
+
+        size = engine.retry(parts_size)
+        engine.retry(upload.cancel_upload)
+        logger.info("aborted multipart upload of %s initiated %s (%d bytes)" % (mp.key_name, mp.initiated, size))
+        return size
+
+    started_before = datetime.utcnow() - older_than
+    orphans = [mp for mp in engine.retry(list_uploads) if parse_ts(mp.initiated) < started_before]
+    try:
+        sizes = list(engine.imap_unordered(abort, orphans))
+    finally:
+        engine.close()
+    return len(sizes), sum(sizes)
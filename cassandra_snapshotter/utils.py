@@ -1,5 +1,7 @@
 import argparse
 import functools
+import hashlib
+from timeout import DEFAULT_SOCKET_TIMEOUT
 
 S3_CONNECTION_HOSTS = {
     'us-east-1': 's3.amazonaws.com',
@@ -12,6 +14,20 @@ S3_CONNECTION_HOSTS = {
     'sa-east-1': 's3-sa-east-1.amazonaws.com'
 }
 
+# summary of all the snapshots of a base path
+CATALOG_INDEX_NAME = '_index'
+
+# content addressed objects shared by all the snapshots of a base path
+OBJECTS_DIR = '_objects'
+
+# per node indexes of the files uploaded by each agent put run
+FILE_INDEX_DIR = '_files'
+
+# file indexes are named after the (utc) time of their put run
+FILE_INDEX_TIME_FORMAT = '%Y%m%d%H%M%S%f'
+
+CHECKSUM_BLOCK_SIZE = 1048576
+
 base_parser = argparse.ArgumentParser(
     formatter_class=argparse.RawDescriptionHelpFormatter,
     description=__doc__)
@@ -20,6 +36,12 @@ base_parser.add_argument('-v', '--verbose',
                          action='store_true',
                          help='increase output verbosity')
 
+base_parser.add_argument('--socket-timeout',
+                         default=DEFAULT_SOCKET_TIMEOUT,
+                         type=int,
+                         help='Seconds without progress after which an S3 request fails (default %d)' %
+                              DEFAULT_SOCKET_TIMEOUT)
+
 
 def add_s3_arguments(arg_parser):
     """
@@ -65,3 +87,20 @@ def map_wrap(f):
     def wrapper(*args, **kwargs):
         return apply(f, *args, **kwargs)
     return wrapper
+
+
+def file_checksum(path, throttle=None):
+    """
+    returns the sha1 hex digest of the content of a file,
+    reads are limited by the disk rate of throttle (a Throttle) if given
+    """
+    checksum = hashlib.sha1()
+    with open(path, 'rb') as file_object:
+        while True:
+            data = file_object.read(CHECKSUM_BLOCK_SIZE)
+            if not data:
+                break
+            if throttle is not None:
+                throttle.disk(len(data))
+            checksum.update(data)
+    return checksum.hexdigest()
@@ -7,7 +7,6 @@ from cassandra_snapshotter import __version__, __maintainer__, __email__
 install_requires = [
     'argparse',
     'fabric',
-    'joblib',
     'boto>=2.29.1',
     'python-snappy'
 ]
@@ -22,6 +21,11 @@ setup(
     packages=find_packages(),
     zip_safe=False,
     install_requires=install_requires,
+    extras_require={
+        'zstd': ['zstandard'],
+        'lz4': ['lz4'],
+        'scandir': ['scandir']
+    },
     include_package_data=True,
     entry_points={
         'console_scripts': [
@@ -0,0 +1,98 @@
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+from cassandra_snapshotter import agent, transfer
+from cassandra_snapshotter.compression import get_codec
+
+
+class FakeKey(object):
+    def __init__(self, bucket, name):
+        self.bucket = bucket
+        self.name = name
+        self.etag = None
+
+    def set_contents_from_file(self, file_object, encrypt_key=False):
+        self.bucket.objects[self.name] = file_object.read()
+        self.etag = '"etag"'
+
+
+class FakeBucket(object):
+    def __init__(self):
+        self.objects = {}
+
+    def new_key(self, name):
+        return FakeKey(self, name)
+
+
+class FakeEngine(transfer.TransferEngine):
+    def __init__(self, bucket):
+        super(FakeEngine, self).__init__('bucket')
+        self.fake_bucket = bucket
+
+    @property
+    def bucket(self):
+        return self.fake_bucket
+
+
+class UploadSinglePartTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_small_uploads_hold_one_buffer(self):
+        # as many buffers as upload threads, as put_from_manifest does with --part-concurrency 1
+        threads_count = 4
+        uploads_count = 50
+        buffers = agent.BufferPool(threads_count, 1024)
+        bucket = FakeBucket()
+        engine = FakeEngine(bucket)
+        codec = get_codec('none')
+        sources = []
+        for i in range(uploads_count):
+            source = os.path.join(self.directory, 'ks-cf-ka-%d-Digest.sha1' % i)
+            with open(source, 'wb') as source_file:
+                source_file.write(b'x' * i)
+            sources.append(source)
+        remaining = list(sources)
+        lock = threading.Lock()
+
+        def upload():
+            while True:
+                with lock:
+                    if not remaining:
+                        return
+                    source = remaining.pop()
+                agent.upload_single_part(engine, source, source, False, codec, buffers)
+
+        threads = [threading.Thread(target=upload) for _ in range(threads_count)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            thread.join(10)
+        self.assertFalse(any(thread.is_alive() for thread in threads))
+        self.assertEqual(sorted(bucket.objects), sorted(sources))
+        for source in sources:
+            with open(source, 'rb') as source_file:
+                self.assertEqual(bucket.objects[source], source_file.read())
+
+    def test_file_larger_than_a_buffer(self):
+        source = os.path.join(self.directory, 'ks-cf-ka-1-Data.db')
+        with open(source, 'wb') as source_file:
+            source_file.write(b'x' * 2048)
+        buffers = agent.BufferPool(1, 1024)
+        engine = FakeEngine(FakeBucket())
+        self.assertRaises(IOError, agent.upload_single_part, engine, source, source, False,
+                          get_codec('none'), buffers)
+        # the buffer went back to the pool
+        buffers.release(buffers.acquire())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,71 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from cassandra_snapshotter import snapshotting
+from cassandra_snapshotter.compression import CodecError, get_codec
+
+
+def codec_available(name):
+    try:
+        get_codec(name).compress(bytearray(b'x'), 1)
+    except (CodecError, ImportError, AttributeError, NameError):
+        return False
+    return True
+
+
+class LocalSourceRestoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.source = os.path.join(self.directory, 'source')
+        self.merge_dir = os.path.join(self.directory, 'merge')
+        self.table_path = os.path.join(self.source, 'h1', 'data', 'ks', 'tbl', 'snapshots', 'S')
+        os.makedirs(self.table_path)
+        self.loaded = []
+        self.call = snapshotting.subprocess.call
+        snapshotting.subprocess.call = lambda command: self.loaded.append(command) or 0
+
+    def tearDown(self):
+        snapshotting.subprocess.call = self.call
+        shutil.rmtree(self.directory)
+
+    def restore(self):
+        worker = snapshotting.RestoreWorker('key', 'secret', None, local_source=self.source,
+                                            merge_dir=self.merge_dir, decompress_processes=0)
+        worker.restore('ks', 'tbl', ['h1'], ['target'])
+        return os.path.join(self.merge_dir, 'ks', 'tbl')
+
+    def write_source(self, name, data, codec_name):
+        codec = get_codec(codec_name)
+        with open(os.path.join(self.table_path, name + codec.suffix), 'wb') as source_file:
+            source_file.write(codec.compress(bytearray(data), len(data)))
+
+    def assertRestored(self, table_dir, name, data):
+        with open(os.path.join(table_dir, 'h1_' + name), 'rb') as restored_file:
+            self.assertEqual(restored_file.read(), data)
+
+    def test_uncompressed_files_are_linked(self):
+        data = b'sstable data' * 1000
+        self.write_source('ks-tbl-ka-1-Data.db', data, 'none')
+        table_dir = self.restore()
+        self.assertRestored(table_dir, 'ks-tbl-ka-1-Data.db', data)
+        self.assertEqual(len(self.loaded), 1)
+
+    def test_compressed_files_are_decompressed(self):
+        codecs = [name for name in ('snappy', 'zstd', 'lz4') if codec_available(name)]
+        if not codecs:
+            self.skipTest('no compression library installed')
+        data = b'sstable data' * 100000
+        for i, codec_name in enumerate(codecs):
+            self.write_source('ks-tbl-ka-%d-Data.db' % (i + 1), data, codec_name)
+        table_dir = self.restore()
+        self.assertEqual(sorted(os.listdir(table_dir)),
+                         ['h1_ks-tbl-ka-%d-Data.db' % (i + 1) for i in range(len(codecs))])
+        for i in range(len(codecs)):
+            self.assertRestored(table_dir, 'ks-tbl-ka-%d-Data.db' % (i + 1), data)
+
+
+if __name__ == '__main__':
+    unittest.main()